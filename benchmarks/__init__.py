@@ -0,0 +1 @@
+# Benchmarks for pglib, run each module from the root of the app with the App Engine SDK on the path
@@ -0,0 +1,50 @@
+"""
+Compare encode/decode time and payload size of the utils.codec codecs against pickling the settings dict, which is
+what memcache did with settings values before the codec layer.
+
+  python benchmarks/codec_benchmark.py [iterations]
+"""
+import os
+import sys
+import timeit
+import cPickle as pickle
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import codec
+
+# values shaped like the settings we cache: a small scalar setting, a typical multi property setting and a big list setting
+VALUES = {
+  'scalar': {'value':True},
+  'typical': {'value':u'Welcome to the site','title':'Home','count':42,'ratio':0.75,'tags':['a','b','c']},
+  'large': {'value':[{'id':i,'name':'item %d' % i,'enabled':i % 2 == 0} for i in range(1000)]},
+}
+
+def measure(encode, decode, value, iterations):
+  # return (encode seconds, decode seconds, payload bytes) for a value
+  data = encode(value)
+  encode_time = timeit.Timer(lambda: encode(value)).timeit(iterations)
+  decode_time = timeit.Timer(lambda: decode(data)).timeit(iterations)
+  return encode_time, decode_time, len(data)
+
+def run(iterations=10000):
+  """Return a list of result dicts, one per (value, codec) pair"""
+  results = []
+  for value_name in sorted(VALUES.keys()):
+    value = VALUES[value_name]
+    n = max(iterations // 100,1) if value_name == 'large' else iterations
+    paths = [('pickled dict',lambda v: pickle.dumps(v,pickle.HIGHEST_PROTOCOL),pickle.loads)]
+    for name in ['pickle','marshal','json']:
+      paths.append((name,lambda v,name=name: codec.encode(v,name),codec.decode))
+    for path,encode,decode in paths:
+      encode_time, decode_time, size = measure(encode,decode,value,n)
+      results.append({'value':value_name,'codec':path,'iterations':n,'encode_us':encode_time/n*1e6,'decode_us':decode_time/n*1e6,'bytes':size})
+  return results
+
+def main():
+  iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  print "%-8s %-13s %11s %11s %8s" % ('value','codec','encode us','decode us','bytes')
+  for r in run(iterations):
+    print "%-8s %-13s %11.2f %11.2f %8d" % (r['value'],r['codec'],r['encode_us'],r['decode_us'],r['bytes'])
+
+if __name__ == '__main__':
+  main()
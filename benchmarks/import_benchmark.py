@@ -0,0 +1,44 @@
+"""
+Measure the cold import time of the pglib packages. Each statement runs in a fresh python process so nothing is cached
+between runs. 'import settings' is the lazy package on its own, 'import settings.functions' is what importing the package
+cost before it was lazy (the package imported its submodules and their App Engine APIs straight away).
+
+  python benchmarks/import_benchmark.py [runs]
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STATEMENTS = [
+  'import settings',
+  'import settings.functions',
+  'import permissions',
+  'import permissions.functions',
+]
+
+TIMER = "import time\nstart = time.time()\n%s\nprint time.time() - start\n"
+
+def measure(statement, runs):
+  # return the best of runs cold import times of the statement in seconds
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join([ROOT]+[p for p in sys.path if p])
+  times = []
+  for i in range(runs):
+    output = subprocess.Popen([sys.executable,'-c',TIMER % statement],cwd=ROOT,env=env,stdout=subprocess.PIPE).communicate()[0]
+    times.append(float(output.strip()))
+  return min(times)
+
+def run(runs=5):
+  """Return a list of result dicts, one per statement"""
+  return [{'statement':statement,'runs':runs,'ms':measure(statement,runs)*1000} for statement in STATEMENTS]
+
+def main():
+  runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+  print "%-30s %10s" % ('statement','best ms')
+  for r in run(runs):
+    print "%-30s %10.2f" % (r['statement'],r['ms'])
+
+if __name__ == '__main__':
+  main()
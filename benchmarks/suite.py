@@ -0,0 +1,187 @@
+"""
+Benchmark settings and permissions calls against the local datastore and memcache stubs. Each benchmark reports wall
+time (ops per second, mean, median and 95th percentile latency) and the rpcs each call made, counted with utils.rpc.
+Results are written as JSON so runs from different versions can be compared.
+
+  python benchmarks/suite.py [--sdk PATH] [--iterations N] [--output FILE] [--compare OLD_FILE] [benchmark ...]
+
+Stub latencies are much lower than production so compare rpc counts as well as times.
+"""
+import optparse
+import os
+import platform
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def setup_stubs(sdk=None):
+  """Put the SDK and the app on the path and install fresh in-memory datastore, memcache, user and taskqueue stubs"""
+  if sdk:
+    sys.path.insert(0,sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+  sys.path.insert(0,ROOT)
+  os.environ.setdefault('APPLICATION_ID','pglib-benchmarks')
+  os.environ.setdefault('AUTH_DOMAIN','example.com')
+  os.environ.setdefault('USER_EMAIL','benchmark@example.com')
+  os.environ.setdefault('SERVER_NAME','localhost')
+  os.environ.setdefault('SERVER_PORT','8080')
+  from google.appengine.api import apiproxy_stub_map
+  from google.appengine.api import datastore_file_stub
+  from google.appengine.api import user_service_stub
+  from google.appengine.api.memcache import memcache_stub
+  from google.appengine.api.taskqueue import taskqueue_stub
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3',datastore_file_stub.DatastoreFileStub(os.environ['APPLICATION_ID'],None,None))
+  apiproxy_stub_map.apiproxy.RegisterStub('memcache',memcache_stub.MemcacheService())
+  apiproxy_stub_map.apiproxy.RegisterStub('user',user_service_stub.UserServiceStub())
+  apiproxy_stub_map.apiproxy.RegisterStub('taskqueue',taskqueue_stub.TaskQueueServiceStub(root_path=ROOT))
+
+def measure(name, op, iterations, setup=None):
+  """
+  Run op iterations times, calling setup (untimed) before each run, and return a result dict of timings and rpc counts
+  """
+  from utils import rpc
+  times = []
+  rpcs = 0
+  services = {}
+  for i in range(iterations):
+    if setup:
+      setup(i)
+    rpc.reset()
+    start = time.time()
+    op(i)
+    times.append(time.time()-start)
+    for stats in rpc.summary().values():
+      rpcs += stats['rpcs']
+      for service,count in stats['services'].items():
+        services[service] = services.get(service,0)+count
+  times.sort()
+  total = sum(times)
+  return {
+    'name': name,
+    'iterations': iterations,
+    'total_s': total,
+    'ops_per_s': iterations/total if total else None,
+    'mean_ms': total/iterations*1000,
+    'p50_ms': times[len(times)//2]*1000,
+    'p95_ms': times[min(int(len(times)*0.95),len(times)-1)]*1000,
+    'rpcs_per_op': float(rpcs)/iterations,
+    'services_per_op': dict([(s,float(c)/iterations) for s,c in services.items()]),
+  }
+
+def _settings_benchmarks(n):
+  import settings
+  from google.appengine.api import memcache
+  for i in range(n):
+    settings.set('bench_%d' % i,is_global=True,value=i)
+    settings.set('bench_%d' % i,value=-i)
+  def fresh_request(i):
+    settings.reset()
+  def cold_request(i):
+    settings.reset()
+    memcache.flush_all()
+  return [
+    ('settings.get hit',lambda i: settings.get('bench_%d' % i),fresh_request),
+    ('settings.get miss',lambda i: settings.get('bench_%d' % i),cold_request),
+    ('settings.get user_first',lambda i: settings.get('bench_%d' % i,user_first=True),fresh_request),
+    ('settings.get_multi 10',lambda i: settings.get_multi(['bench_%d' % ((i+j) % n) for j in range(10)]),fresh_request),
+    ('settings.set',lambda i: settings.set('bench_%d' % i,is_global=True,value=i+1),fresh_request),
+  ]
+
+def _permissions_benchmarks(n):
+  import permissions
+  from google.appengine.ext import db
+  class BenchObject(db.Model):
+    name = db.StringProperty()
+  objs = db.put([BenchObject(name=str(i)) for i in range(max(n,100))])
+  checked = permissions.create('bench.checked')
+  permissions.bind(checked,*objs[::2])
+  several = [permissions.create('bench.several.%d' % i) for i in range(10)]
+  permissions.bind(several[0],*objs)
+  many = permissions.create('bench.many')
+  benchmarks = [
+    ('permissions.create',lambda i: permissions.create('bench.create.%d' % i),None),
+    ('permissions.has_permission',lambda i: permissions.has_permission(objs[i % len(objs)],checked),None),
+    ('permissions.has_permissions 10',lambda i: permissions.has_permissions(objs[i % len(objs)],several),None),
+  ]
+  for fanout in (1,10,100):
+    benchmarks.append(('permissions.bind fan-out %d' % fanout,lambda i,fanout=fanout: permissions.bind(many,*objs[:fanout]),None))
+  benchmarks.append(('permissions.unbind',lambda i: permissions.unbind(many,objs[i % len(objs)]),lambda i: permissions.bind(many,objs[i % len(objs)])))
+  # deleting a permission with many bindings, a fresh permission bound to every obj is made for each run
+  doomed = {}
+  def bind_many(i):
+    doomed[i] = permissions.create('bench.doomed.%d' % i)
+    permissions.bind(doomed[i],*objs)
+  benchmarks.append(('permissions.delete %d bindings' % len(objs),lambda i: permissions.delete(doomed.pop(i)),bind_many))
+  return benchmarks
+
+def run(iterations=100, names=None):
+  """
+  Run the benchmarks (all of them or just those whose names start with one of names) and return the JSON report dict.
+  The stubs must be installed first, see setup_stubs
+  """
+  import constants
+  constants.RPC_ACCOUNTING = True
+  results = []
+  for benchmarks in (_settings_benchmarks,_permissions_benchmarks):
+    for name,op,setup in benchmarks(iterations):
+      if names and len([n for n in names if name.startswith(n)]) == 0:
+        continue
+      results.append(measure(name,op,iterations,setup))
+  return {
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'python': platform.python_version(),
+    'version': _version(),
+    'constants': dict([(k,getattr(constants,k)) for k in dir(constants) if k.isupper()]),
+    'results': results,
+  }
+
+def compare(old, new):
+  """Return a list of (name, old mean ms, new mean ms, old rpcs per op, new rpcs per op) for benchmarks in both reports"""
+  before = dict([(r['name'],r) for r in old['results']])
+  return [(r['name'],before[r['name']]['mean_ms'],r['mean_ms'],before[r['name']]['rpcs_per_op'],r['rpcs_per_op']) for r in new['results'] if r['name'] in before]
+
+def _version():
+  # the git revision of the tree being measured, if there is one
+  try:
+    import subprocess
+    return subprocess.Popen(['git','describe','--always','--dirty'],cwd=ROOT,stdout=subprocess.PIPE,stderr=subprocess.PIPE).communicate()[0].strip() or None
+  except OSError:
+    return None
+
+def main():
+  try:
+    import json
+  except ImportError:
+    from django.utils import simplejson as json
+  parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+  parser.add_option('--sdk',help="path of the App Engine SDK if it isnt already importable")
+  parser.add_option('--iterations',type='int',default=100)
+  parser.add_option('--output',help="write the JSON report to this file instead of stdout")
+  parser.add_option('--compare',help="print a comparison with an earlier JSON report")
+  options, names = parser.parse_args()
+  setup_stubs(options.sdk)
+  report = run(options.iterations,names)
+  data = json.dumps(report,indent=2,sort_keys=True)
+  if options.output:
+    f = open(options.output,'w')
+    try:
+      f.write(data)
+    finally:
+      f.close()
+  else:
+    print data
+  if options.compare:
+    f = open(options.compare)
+    try:
+      old = json.load(f)
+    finally:
+      f.close()
+    print >>sys.stderr, "%-36s %10s %10s %8s %10s %10s" % ('benchmark','old ms','new ms','change','old rpcs','new rpcs')
+    for name,old_ms,new_ms,old_rpcs,new_rpcs in compare(old,report):
+      print >>sys.stderr, "%-36s %10.3f %10.3f %+7.1f%% %10.2f %10.2f" % (name,old_ms,new_ms,(new_ms/old_ms-1)*100 if old_ms else 0,old_rpcs,new_rpcs)
+
+if __name__ == '__main__':
+  main()
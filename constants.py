@@ -6,3 +6,89 @@ USE_MEMCACHE=False
 
 MAX_FETCH_LIMIT=1000
 
+# maximum number of entities passed to a single db.put / db.get / db.delete call
+MAX_BATCH_SIZE=500
+
+# number of times a memcache compare-and-set is retried before giving up
+MEMCACHE_CAS_RETRIES=5
+
+# maintain a compact per-object bitmap of permission ids and answer has_permission from it
+USE_PERMISSION_BITMAPS=False
+
+# number of seconds a cached has_permission result is kept in memcache (0 = no expiry)
+PERMISSION_CACHE_TIME=3600
+
+# number of seconds a cached has_permission result stays locked after it is invalidated, so a check that read the
+# datastore before a bind or unbind cant put its out of date result back
+PERMISSION_LOCK_TIME=10
+
+# a group binding change reaching more members than this (directly or through other groups) is applied to them by task
+# queue workers a batch at a time, until they run the members keep their old result
+PERMISSION_REFRESH_INLINE=500
+
+# url of the task queue worker that applies group binding changes to members (see permissions/handlers.py and app.yaml)
+PERMISSIONS_REFRESH_URL='/_pglib/permissions/refresh'
+
+# number of seconds memcache remembers that a setting does not exist
+SETTINGS_MISSING_CACHE_TIME=600
+
+# settings.set_write_behind coalesces writes to a setting over this many seconds before flushing them to the datastore
+SETTINGS_WRITE_BEHIND_WINDOW=10
+
+# url of the task queue worker that flushes write-behind settings (see settings/handlers.py and app.yaml)
+SETTINGS_FLUSH_URL='/_pglib/settings/flush'
+
+# number of seconds a write-behind value is kept in memcache waiting to be flushed
+SETTINGS_PENDING_TIME=86400
+
+# keep a snapshot of every global setting in instance memory, reloaded only when a global setting is written
+USE_SETTINGS_SNAPSHOT=False
+
+# number of seconds between checks of the global settings generation in memcache when USE_SETTINGS_SNAPSHOT is set
+SETTINGS_SNAPSHOT_CHECK_TIME=5
+
+# number of seconds a write to a global setting is read back by key when the snapshot is reloaded, as the reload query
+# may not see it straight away
+SETTINGS_SNAPSHOT_RECHECK_TIME=60
+
+# values bigger than this many bytes (pickled) are split across several memcache items by utils.cache.Client
+MEMCACHE_CHUNK_SIZE=950000
+
+# compress values with zlib before they are split into chunks
+MEMCACHE_COMPRESS=True
+
+# codec used for values cached by utils.cache.Client (see utils/codec.py): 'marshal', 'json' or 'pickle'
+CACHE_CODEC='marshal'
+
+# keep recently used settings, permissions and has_permission results in a bounded cache in instance memory (utils/lru.py)
+USE_LOCAL_CACHE=False
+
+# maximum number of entries in the instance memory cache, the least recently used entry is evicted first
+LOCAL_CACHE_SIZE=10000
+
+# approximate number of bytes (encoded with utils.codec) the instance memory cache may hold before it evicts entries
+LOCAL_CACHE_BYTES=16*1024*1024
+
+# values bigger than this many bytes (encoded) are never kept in the instance memory cache
+LOCAL_CACHE_VALUE_BYTES=100000
+
+# number of seconds an entry is kept in the instance memory cache, this bounds how stale it can be after a write made
+# by another instance (writes made by this instance update it straight away)
+LOCAL_CACHE_TIME=60
+
+# only let one request fill a missing settings or has_permission cache key from the datastore, the others wait for it
+# (or serve the last value filled for a setting) instead of all querying the datastore at once
+USE_CACHE_LEASES=False
+
+# number of seconds a fill lease is held before another request may take it over
+CACHE_LEASE_TIME=5
+
+# seconds between checks for a value being filled by another request, and the number of checks before giving up
+CACHE_LEASE_WAIT=0.05
+CACHE_LEASE_RETRIES=5
+
+# number of seconds the stale copy of a filled setting is kept
+CACHE_STALE_TIME=86400
+
+# count the rpcs, bytes and rpc latency of every pglib call (see utils/rpc.py), costs one check per call when off
+RPC_ACCOUNTING=False
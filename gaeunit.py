@@ -21,6 +21,13 @@ Usage:
 
 4. The results are displayed as the tests are run.
 
+5. To run the tests from the command line across several worker processes, run
+   this from the application directory with the SDK on the python path:
+
+   python gaeunit.py --processes 4 [test names]
+
+   The merged results are printed as JSON, including the time each test took.
+
 Visit http://code.google.com/p/gaeunit for more information and updates.
 
 ------------------------------------------------------------------------------
@@ -73,6 +80,7 @@ from google.appengine.ext.webapp.util import run_wsgi_app
 
 _LOCAL_TEST_DIR = 'test'  # location of files
 _WEB_TEST_DIR = '/test'   # how you want to refer to tests on your web server
+_RESET_PER_TEST = True    # empty the test datastore and memcache before every test
 
 # or:
 # _WEB_TEST_DIR = '/u/test'
@@ -139,16 +147,38 @@ class JsonTestResult(unittest.TestResult):
     def __init__(self):
         unittest.TestResult.__init__(self)
         self.testNumber = 0
+        self.timings = []
+        self._merged = {'errors': [], 'failures': []}
 
-    def render_to(self, stream):
-        result = {
+    def startTest(self, test):
+        unittest.TestResult.startTest(self, test)
+        self._startTime = time.time()
+
+    def stopTest(self, test):
+        unittest.TestResult.stopTest(self, test)
+        self.timings.append({'ut_id': test.id(), 'seconds': time.time() - self._startTime})
+
+    def to_dict(self):
+        return {
             'runs': self.testsRun,
             'total': self.testNumber,
-            'errors': self._list(self.errors),
-            'failures': self._list(self.failures),
+            'errors': self._list(self.errors) + self._merged['errors'],
+            'failures': self._list(self.failures) + self._merged['failures'],
+            'timings': self.timings,
             }
 
-        stream.write(django.utils.simplejson.dumps(result).replace('},', '},\n'))
+    def merge(self, result):
+        """Add the results of a shard (the to_dict of its JsonTestResult) to this result."""
+        self.testsRun += result['runs']
+        self._merged['errors'].extend(result['errors'])
+        self._merged['failures'].extend(result['failures'])
+        self.timings.extend(result['timings'])
+
+    def wasSuccessful(self):
+        return unittest.TestResult.wasSuccessful(self) and not self._merged['errors'] and not self._merged['failures']
+
+    def render_to(self, stream):
+        stream.write(django.utils.simplejson.dumps(self.to_dict()).replace('},', '},\n'))
 
     def _list(self, list):
         dict = []
@@ -288,19 +318,129 @@ def _run_test_suite(runner, suite):
     original_apiproxy = apiproxy_stub_map.apiproxy
     try:
        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap() 
+       # With no file paths the stub is kept in memory only
        temp_stub = datastore_file_stub.DatastoreFileStub('GAEUnitDataStore', None, None, trusted=True)  
        apiproxy_stub_map.apiproxy.RegisterStub('datastore', temp_stub)
        # Allow the other services to be used as-is for tests.
-       for name in ['user', 'urlfetch', 'mail', 'memcache', 'images']: 
+       for name in ['user', 'urlfetch', 'mail', 'memcache', 'images', 'taskqueue']: 
            apiproxy_stub_map.apiproxy.RegisterStub(name, original_apiproxy.GetStub(name))
        # Attempt to copy hooks from the original_apiproxy to the new apiproxy
        apiproxy_stub_map.apiproxy._APIProxyStubMap__precall_hooks = original_apiproxy._APIProxyStubMap__precall_hooks
        apiproxy_stub_map.apiproxy._APIProxyStubMap__postcall_hooks = original_apiproxy._APIProxyStubMap__postcall_hooks
+       if _RESET_PER_TEST:
+           suite = _IsolatedSuite(suite, lambda: _reset_stubs(temp_stub))
        runner.run(suite)
     finally:
        apiproxy_stub_map.apiproxy = original_apiproxy
 
 
+class _IsolatedSuite(unittest.TestSuite):
+    """Runs every test of a suite with reset() called first, so no test sees data left by another."""
+    def __init__(self, suite, reset):
+        tests = []
+        _get_tests_from_suite(suite, tests)
+        unittest.TestSuite.__init__(self, tests)
+        self._reset = reset
+
+    def run(self, result):
+        for test in self._tests:
+            if result.shouldStop:
+                break
+            self._reset()
+            test(result)
+        return result
+
+
+def _reset_stubs(datastore_stub):
+    # Clearing the in-memory stub is much cheaper than creating a new one
+    from google.appengine.api import memcache
+    datastore_stub.Clear()
+    memcache.flush_all()
+    _reset_process_caches()
+
+
+def _reset_process_caches():
+    # pglib also caches in process memory (the settings request cache and snapshot, the LRU cache and the permission
+    # trie), drop those too so no test sees another's values. Modules that haven't been imported yet are left alone
+    lru = sys.modules.get('utils.lru')
+    if lru is not None:
+        lru.shared.clear()
+    settings = sys.modules.get('settings.functions')
+    if settings is not None:
+        settings.reset()
+        settings._snapshot['snapshot'] = None
+        settings._flush_window['window'] = None
+    permissions = sys.modules.get('permissions.functions')
+    if permissions is not None:
+        permissions._trie['version'] = None
+        permissions._trie['root'] = None
+
+
+def _run_shard(test_ids):
+    # Run in a worker process: run the named tests and return the to_dict of their JsonTestResult
+    _load_default_test_modules()
+    suite = unittest.defaultTestLoader.loadTestsFromNames(test_ids)
+    runner = JsonTestRunner()
+    _run_test_suite(runner, suite)
+    return runner.result.to_dict()
+
+
+def run_sharded(suite, processes=None):
+    """Split the suite across worker processes and return a JsonTestResult of every shard's results.
+
+    Tests are dealt out round robin. Each worker runs its shard against its own copy of the stubs, so this needs
+    the stubs set up before the workers are forked and a platform with multiprocessing (the command line rather
+    than the development web server).
+    """
+    import multiprocessing
+    tests = []
+    _get_tests_from_suite(suite, tests)
+    processes = min(processes or multiprocessing.cpu_count(), max(len(tests), 1))
+    shards = [[test.id() for test in tests[i::processes]] for i in range(processes)]
+    result = JsonTestResult()
+    result.testNumber = len(tests)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for shard_result in pool.map(_run_shard, [shard for shard in shards if shard]):
+            result.merge(shard_result)
+    finally:
+        pool.close()
+        pool.join()
+    return result
+
+
+def _setup_command_line_stubs():
+    # Stubs for running tests outside the development web server, _run_test_suite copies them from here
+    from google.appengine.api import user_service_stub
+    from google.appengine.api.memcache import memcache_stub
+    from google.appengine.api.taskqueue import taskqueue_stub
+    os.environ.setdefault('APPLICATION_ID', 'gaeunit')
+    os.environ.setdefault('AUTH_DOMAIN', 'example.com')
+    os.environ.setdefault('USER_EMAIL', 'test@example.com')
+    os.environ.setdefault('SERVER_NAME', 'localhost')
+    os.environ.setdefault('SERVER_PORT', '8080')
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
+    apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheService())
+    apiproxy_stub_map.apiproxy.RegisterStub('taskqueue', taskqueue_stub.TaskQueueServiceStub(root_path='.'))
+
+
+def _main_sharded(argv):
+    # python gaeunit.py --processes N [test names]: run the tests across N worker processes and print the JSON result
+    processes = int(argv[2])
+    _setup_command_line_stubs()
+    modules = _load_default_test_modules()
+    loader = unittest.defaultTestLoader
+    if len(argv) > 3:
+        suite = loader.loadTestsFromNames(argv[3:])
+    else:
+        suite = unittest.TestSuite([loader.loadTestsFromModule(module) for module in modules])
+    result = run_sharded(suite, processes)
+    result.render_to(sys.stdout)
+    sys.stdout.write('\n')
+    return result.wasSuccessful()
+
+
 def _log_error(s):
    logging.warn(s)
    return s
@@ -475,4 +615,6 @@ def main():
     run_wsgi_app(application)                                    
 
 if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--processes':
+        sys.exit(not _main_sharded(sys.argv))
     main()
@@ -0,0 +1,38 @@
+"""
+Lazy loading of package attributes, so importing a pglib package doesnt import its submodules (and the App Engine APIs
+they use) until one of its names is first used. Python 2 modules cant define __getattr__ so the package module in
+sys.modules is swapped for a LazyModule that can.
+"""
+import sys
+import types
+
+class LazyModule(types.ModuleType):
+  """
+  A package module whose lazy attributes are imported on first use. lazy maps each public name to a tuple of
+  (submodule name, attribute name), an attribute name of None means the submodule itself
+  """
+  def __init__(self, module, lazy):
+    types.ModuleType.__init__(self, module.__name__, module.__doc__)
+    self.__dict__.update(module.__dict__)
+    # keep the original module alive, python 2 clears the globals of a module when it is freed
+    self.__dict__['_module'] = module
+    self.__dict__['_lazy'] = lazy
+  
+  def __getattr__(self, name):
+    # only called for names that havent been loaded yet
+    if name not in self._lazy:
+      raise AttributeError("'module' object has no attribute '"+name+"'")
+    submodule, attribute = self._lazy[name]
+    module = __import__(self.__name__+'.'+submodule, {}, {}, [submodule])
+    value = module if attribute is None else getattr(module, attribute)
+    setattr(self, name, value)
+    return value
+  
+  def __dir__(self):
+    return sorted(frozenset(self.__dict__.keys()) | frozenset(self._lazy.keys()))
+  
+def install(name, lazy):
+  """
+  Replace the module called name in sys.modules with a LazyModule, call this at the end of a package __init__
+  """
+  sys.modules[name] = LazyModule(sys.modules[name], lazy)
@@ -1,11 +1,32 @@
-import models
-import functions
+import lazy
 
 __all__ = ['models','functions']
 
-get = functions.get
-create = functions.create
-delete = functions.delete
-bind = functions.bind
-unbind = functions.unbind
-has_permission = functions.has_permission
+# public names are imported from the submodules on first use, see lazy.py
+lazy.install(__name__, {
+  'models': ('models', None),
+  'functions': ('functions', None),
+  'get': ('functions', 'get'),
+  'get_async': ('functions', 'get_async'),
+  'find': ('functions', 'find'),
+  'create': ('functions', 'create'),
+  'delete': ('functions', 'delete'),
+  'bind': ('functions', 'bind'),
+  'bind_async': ('functions', 'bind_async'),
+  'unbind': ('functions', 'unbind'),
+  'has_permission': ('functions', 'has_permission'),
+  'has_permission_async': ('functions', 'has_permission_async'),
+  'has_permissions': ('functions', 'has_permissions'),
+  'has_permission_many': ('functions', 'has_permission_many'),
+  'has_action': ('functions', 'has_action'),
+  'create_group': ('functions', 'create_group'),
+  'get_group': ('functions', 'get_group'),
+  'delete_group': ('functions', 'delete_group'),
+  'add_member': ('functions', 'add_member'),
+  'remove_member': ('functions', 'remove_member'),
+  'get_members': ('functions', 'get_members'),
+  'get_groups': ('functions', 'get_groups'),
+  'get_bitmap': ('functions', 'get_bitmap'),
+  'build_bitmaps': ('functions', 'build_bitmaps'),
+  'migrate_bindings': ('functions', 'migrate_bindings'),
+})
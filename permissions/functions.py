@@ -1,57 +1,168 @@
 import models
 import utils
-from google.appengine.api import memcache
-from google.appengine.api import users
+import constants
 from google.appengine.ext import db
-import logging
+import threading
+import uuid
+from utils import cache
+from utils import lru
+from utils import rpc
 
+# memcache key for the cached result of a has_permission check
+BINDING_KEY=lambda p,o: "binding_"+str(p)+"_"+str(o)
+# instance memory cache key of a permission found by get
+PERMISSION_KEY=lambda a,o: "permission_"+utils.key_name(a)+"_"+_trie_obj(o)
+# memcache keys for the permission bitmap of an obj and the bit id of a permission
+BITMAP_KEY=lambda o: "bitmap_"+str(o)
+BIT_KEY=lambda p: "bit_"+str(p)
+# memcache keys for the prefix trie of known permissions and its version number
+TRIE_KEY="permissions_trie"
+TRIE_VERSION_KEY="permissions_trie_version"
+# trie node key holding {obj key or '': permission key name} for the actions ending at that node (never a segment as segments are split on '.')
+TRIE_LEAF='.'
 
+# process wide copy of the trie, reloaded from memcache whenever the version number changes
+_trie = {'version':None,'root':None}
+# per-thread memcache client
+_local = threading.local()
+
+@rpc.accounted
 def get(action,obj=None):
   """
   Retrieve the permission specified by the name and obj
+  An action ending in '*' (e.g. "doc.edit.*") returns the list of permissions under that prefix instead, see find
+  Actions are matched like key names, ignoring case and spaces. When USE_MEMCACHE is set permissions are looked up in the
+  trie of known permissions, a permission the trie doesnt have yet is looked for by key name
+  """
+  return get_async(action,obj).get_result()
+  
+@rpc.accounted
+def get_async(action,obj=None):
+  """
+  Start retrieving a permission and return a utils.Future of the result get would return
   """
-  m = models.Permission.get_by_key_name(utils.key_name(action,obj))
-  if m is None:
-    m = models.Permission.all().filter('action',action).filter('obj',obj).get()
-  if m is not None:
+  if action.endswith('*'):
+    return utils.Future(lambda: find(action[:-1].rstrip('.'),obj))
+  if constants.USE_LOCAL_CACHE:
+    m = lru.shared.get(PERMISSION_KEY(action,obj))
+    if m is not None:
+      return utils.Future(lambda: m)
+  def cached(m):
+    # only permissions that exist are kept, so a permission created on another instance is seen straight away
+    if constants.USE_LOCAL_CACHE and m is not None:
+      lru.shared.set(PERMISSION_KEY(action,obj),m)
     return m
-  else:
-    return None
-    
-
+  if constants.USE_MEMCACHE:
+    key_name = _trie_leaf(_load_trie(),action,obj)
+    if key_name is not None:
+      return utils.Future(lambda found: cached(found[0]),utils.batch_get_async([db.Key.from_path(models.Permission.kind(),key_name)]))
+  def found(permissions):
+    m = permissions[0]
+    if m is None and not constants.USE_MEMCACHE:
+      m = models.Permission.all().filter('action',action).filter('obj',obj).get()
+    elif m is not None and constants.USE_MEMCACHE:
+      # the trie was rebuilt by a query that didnt see the permission yet, add it so the next lookup finds it
+      _update_trie(lambda root: _trie_insert(root,m.action,obj,m.key().name()))
+    return cached(m)
+  return utils.Future(found,utils.batch_get_async([db.Key.from_path(models.Permission.kind(),utils.key_name(action,obj))]))
+  
+@rpc.accounted
 def create(action,obj=None,desc=""):
   """
   Create a permission record for the given action and optional obj
   Returns the permission instance that was created (NOT a key)
   """
   permission = models.Permission.get_or_insert(utils.key_name(action,obj),action=action,obj=obj,desc=desc)
+  if constants.USE_MEMCACHE and _trie_leaf(_load_trie(),action,obj) is None:
+    _update_trie(lambda root: _trie_insert(root,action,obj,permission.key().name()))
   return permission
   
+@rpc.accounted
+def find(prefix,obj=None):
+  """
+  Return every permission whose action is prefix or starts with prefix followed by a '.', only those for obj when it is given.
+  Answered from the trie of known permissions with a single batch get when USE_MEMCACHE is set, otherwise with a query
+  on the range of key names starting with the prefix
+  """
+  if not constants.USE_MEMCACHE:
+    return _find_by_key_name(prefix,obj)
+  node = _trie_root(_load_trie(),prefix)
+  key_names = []
+  for leaf in _trie_leaves(node):
+    if obj is None:
+      key_names.extend(leaf.values())
+    elif _trie_obj(obj) in leaf:
+      key_names.append(leaf[_trie_obj(obj)])
+  return [p for p in utils.batch_get([db.Key.from_path(models.Permission.kind(),k) for k in key_names]) if p is not None]
+  
+@rpc.accounted
+def has_action(obj,action,target=None):
+  """
+  Return True if the obj holds the permission for the action (on the target) or a wildcard permission above it in the
+  action hierarchy, e.g. holding "doc.*" or "doc.edit.*" grants "doc.edit.body". When USE_MEMCACHE is set only the
+  permissions in the trie are checked
+  """
+  segments = action.split('.')
+  actions = [action] + ['.'.join(segments[:i]+['*']) for i in range(len(segments)-1,-1,-1)]
+  if constants.USE_MEMCACHE:
+    root = _load_trie()
+    key_names = [_trie_leaf(root,a,target) for a in actions]
+  else:
+    # without the trie every candidate is checked, permissions that dont exist have no bindings so they are never held
+    key_names = [utils.key_name(a,target) for a in actions]
+  permissions = [db.Key.from_path(models.Permission.kind(),k) for k in key_names if k is not None]
+  if len(permissions) == 0:
+    return False
+  return True in has_permissions(obj,permissions).values()
+  
 # def create_permissions(*args,obj=None):
   
+@rpc.accounted
 def delete(permission):
   """
   Delete a permission record and all of its bindings / memcache records.
   """
-  bindings_keys = utils.fetch_all(models.PermissionBinding.all(keys_only=True).filter('permission',permission))
-  db.delete(bindings_keys)
+  _delete_bindings(permission)
   # Remove permission object itself
   permission.delete()
+  if constants.USE_MEMCACHE:
+    utils.remove_dependants([permission])
+  obj = models.Permission.obj.get_value_for_datastore(permission)
+  lru.shared.delete(PERMISSION_KEY(permission.action,obj))
+  _update_trie(lambda root: _trie_remove(root,permission.action,obj))
+  # and forget it was ever inherited
+  permission = utils.object_to_key(permission)
+  for batch in utils.iter_batches(models.EffectivePermissions.all(keys_only=True).filter('permissions',permission),constants.MAX_BATCH_SIZE):
+    _update_inherited(permission,False,[_effective_obj(k) for k in batch])
+  if constants.USE_MEMCACHE:
+    _client().delete(BIT_KEY(permission))
   
+@rpc.accounted
 def bind(permission,*args):
   """
   Bind the given permission to the objs passed in args
-  Return keys for all the bindings created
+  Return keys for all the bindings created. Binding keys are derived from the permission and obj so binding twice is harmless.
+  """
+  return bind_async(permission,*args).get_result()
+  
+@rpc.accounted
+def bind_async(permission,*args):
+  """
+  Return a utils.Future of the binding keys bind would return. The bindings are put straight away but cached checks
+  are only invalidated (and groups refreshed) when the Future is waited on, until then checks may still say the objs
+  dont hold the permission. Always wait on the result
   """
   permission = utils.object_to_key(permission)
   args = [utils.object_to_key(arg) for arg in args]
-  bindings = []
-  for arg in args:
-    bindings.append(models.PermissionBinding(permission=permission,obj=arg).put())
-    # create memcache objects
-  return bindings
-  
+  def bound(bindings):
+    _uncache(permission,args)
+    if constants.USE_PERMISSION_BITMAPS:
+      _set_direct_bits(permission,args,True)
+    _refresh_permission(permission,_groups(args),True)
+    return bindings
+  return utils.Future(bound,utils.batch_put_async([models.PermissionBinding(key_name=_binding_key(permission,arg).name(),permission=permission,obj=arg) for arg in args]))
   
+@rpc.accounted
 def unbind(permission,*args):
   """
   Unbind the permission from the given objects, if no objects given unbind the permission from all objects (delete all bindings where permission=permission)
@@ -59,26 +170,640 @@ def unbind(permission,*args):
   """
   count = 0
   if len(args) == 0:
-    bindings = utils.fetch_all(models.PermissionBinding.all(keys_only=True).filter('permission',permission))
-    count += len(bindings)
-    db.delete(bindings)
+    count += _delete_bindings(permission)
   else:
-    for arg in args:
-      bindings = utils.fetch_all(models.PermissionBinding.all(keys_only=True).filter('permission',permission).filter('obj',arg))
-      count += len(bindings)
-      db.delete(bindings)
+    args = [utils.object_to_key(arg) for arg in args]
+    bindings = [b.key() for b in utils.batch_get([_binding_key(permission,arg) for arg in args]) if b is not None]
+    count += len(bindings)
+    utils.batch_delete(bindings)
+    _uncache(permission,args)
+    if constants.USE_PERMISSION_BITMAPS:
+      _set_direct_bits(permission,args,False)
+    _refresh_permission(permission,_groups(args),False)
   return count
 
+@rpc.accounted
 def has_permission(obj,permission):
-  # is there a binding from the obj to the permission
-  logging.info(obj)
-  logging.info(permission)
-  binding = models.PermissionBinding.all().filter('permission',permission).filter('obj',obj).get()
-  logging.info(binding)
-  if binding is None:
-    return False
+  """
+  Return True if there is a binding from the obj to the permission, or the obj inherits it from one of its groups.
+  When USE_MEMCACHE is set both hits and misses are cached, so a repeated check costs a single memcache get.
+  """
+  return has_permission_async(obj,permission).get_result()
+  
+@rpc.accounted
+def has_permission_async(obj,permission):
+  """
+  Start checking a permission and return a utils.Future of the result has_permission would return
+  """
+  obj = utils.object_to_key(obj)
+  permission = utils.object_to_key(permission)
+  return utils.Future(lambda results: results[(obj,permission)],_check_async([obj],[permission]))
+  
+@rpc.accounted
+def has_permissions(obj,permissions):
+  """
+  Check a list of permissions against a single obj in one round-trip.
+  Returns a dict of {permission key: True/False}
+  """
+  obj = utils.object_to_key(obj)
+  results = _check([obj],permissions)
+  return dict([(p,result) for (o,p),result in results.items()])
+  
+@rpc.accounted
+def has_permission_many(objs,permission):
+  """
+  Check a single permission against a list of objs in one round-trip.
+  Returns a dict of {obj key: True/False}
+  """
+  permission = utils.object_to_key(permission)
+  results = _check(objs,[permission])
+  return dict([(o,result) for (o,p),result in results.items()])
+  
+def _check(objs,permissions):
+  # resolve every (obj, permission) pair, see _check_async
+  return _check_async(objs,permissions).get_result()
+  
+def _check_async(objs,permissions):
+  # resolve every (obj, permission) pair with at most one memcache.get_multi and one db.get (or from the bitmaps when they are in use)
+  # returns a Future of a dict of {(obj key, permission key): True/False}
+  objs = [utils.object_to_key(o) for o in objs]
+  permissions = [utils.object_to_key(p) for p in permissions]
+  pairs = [(o,p) for o in objs for p in permissions]
+  if constants.USE_PERMISSION_BITMAPS:
+    def from_bitmaps():
+      bitmaps = _bitmaps(objs)
+      bits = _permission_bits(permissions)
+      return dict([((o,p),p in bits and utils.test_bit(bitmaps[o],bits[p])) for o,p in pairs])
+    return utils.Future(from_bitmaps)
+  results = {}
+  def from_datastore(missing,missing_objs,leased,entities):
+    effective = dict(zip(missing_objs,entities[:len(missing_objs)]))
+    fetched = {}
+    for (o,p),binding in zip(missing,entities[len(missing_objs):]):
+      results[(o,p)] = binding is not None or (effective[o] is not None and p in effective[o].permissions)
+      fetched[BINDING_KEY(p,o)] = results[(o,p)]
+    # results are added, never set, so a check that read the datastore before a bind or unbind invalidated (and locked)
+    # its key cant store an out of date result. Only the results memcache accepted are kept in instance memory
+    if constants.USE_MEMCACHE and constants.USE_CACHE_LEASES:
+      failed = _client().fill_multi(fetched,leased,time=constants.PERMISSION_CACHE_TIME,stale=False)
+    elif constants.USE_MEMCACHE:
+      failed = _client().add_multi(fetched,time=constants.PERMISSION_CACHE_TIME)
+    else:
+      failed = []
+    if constants.USE_LOCAL_CACHE:
+      lru.shared.set_multi(dict([(k,v) for k,v in fetched.items() if k not in failed]))
+    return results
+  def from_memcache(cached):
+    for o,p in pairs:
+      if cached.get(BINDING_KEY(p,o)) is not None:
+        results[(o,p)] = cached[BINDING_KEY(p,o)]
+    if constants.USE_LOCAL_CACHE and len(cached) > 0:
+      lru.shared.set_multi(cached)
+    missing = [pair for pair in pairs if pair not in results]
+    leased = frozenset()
+    if constants.USE_MEMCACHE and constants.USE_CACHE_LEASES and len(missing) > 0:
+      # wait for checks being filled by other requests, stale results are never used as they could grant a revoked permission
+      leased = frozenset(_client().lease_multi([BINDING_KEY(p,o) for o,p in missing]))
+      filled = _client().wait_multi([BINDING_KEY(p,o) for o,p in missing if BINDING_KEY(p,o) not in leased],stale=False)
+      for o,p in missing:
+        if BINDING_KEY(p,o) in filled:
+          results[(o,p)] = filled[BINDING_KEY(p,o)]
+      missing = [pair for pair in missing if pair not in results]
+    if len(missing) == 0:
+      return results
+    # the effective permissions of each obj are fetched in the same batch as the bindings
+    missing_objs = list(frozenset([o for o,p in missing]))
+    keys = [_effective_key(o) for o in missing_objs]+[_binding_key(p,o) for o,p in missing]
+    return utils.Future(lambda entities: from_datastore(missing,missing_objs,leased,entities),utils.batch_get_async(keys))
+  # the instance memory cache is checked first and only its misses are looked up in memcache
+  if constants.USE_LOCAL_CACHE:
+    local = lru.shared.get_multi([BINDING_KEY(p,o) for o,p in pairs])
+    for o,p in pairs:
+      if BINDING_KEY(p,o) in local:
+        results[(o,p)] = local[BINDING_KEY(p,o)]
+  unresolved = [(o,p) for o,p in pairs if (o,p) not in results]
+  if constants.USE_MEMCACHE and len(unresolved) > 0:
+    return utils.Future(from_memcache,_client().get_multi_async([BINDING_KEY(p,o) for o,p in unresolved]))
+  return utils.Future(lambda: from_memcache({}))
+  
+@rpc.accounted
+def create_group(name,desc=""):
+  """
+  Create a group that permissions can be bound to and objects (including other groups) can be added to
+  Returns the group instance that was created (NOT a key)
+  """
+  return models.Group.get_or_insert(utils.key_name(name),name=name,desc=desc)
+  
+@rpc.accounted
+def get_group(name):
+  """
+  Retrieve the group with the given name or None
+  """
+  return models.Group.get_by_key_name(utils.key_name(name))
+  
+@rpc.accounted
+def delete_group(group):
+  """
+  Delete a group along with its memberships and bindings, its members lose the permissions they held through it
+  """
+  group = utils.object_to_key(group)
+  members = get_members(group)
+  effective = db.get(_effective_key(group))
+  bindings = utils.fetch_all(models.PermissionBinding.all(keys_only=True).filter('obj',group))
+  memberships = utils.fetch_all(models.GroupMembership.all(keys_only=True).filter('group',group))
+  memberships.extend(utils.fetch_all(models.GroupMembership.all(keys_only=True).filter('member',group)))
+  utils.batch_delete(bindings+memberships+[group,_effective_key(group)])
+  held = [utils.key_name_to_keys(k.name())[0] for k in bindings if k.name() is not None]
+  if effective is not None:
+    held.extend(effective.permissions)
+  _uncache_multi(dict([(permission,[group]) for permission in held]))
+  # the memberships were just deleted so the members are refreshed without asking for their groups again
+  _refresh(members,dict([(m,[g for g in get_groups(m) if g != group]) for m in members]))
+  
+@rpc.accounted
+def add_member(group,*args):
+  """
+  Add the objs passed in args to the group, they (and their members) inherit every permission bound to the group
+  Returns keys for all the memberships created
+  """
+  group = utils.object_to_key(group)
+  args = [utils.object_to_key(arg) for arg in args]
+  memberships = utils.batch_put([models.GroupMembership(key_name=_membership_key(group,arg).name(),group=group,member=arg) for arg in args])
+  # the query for the groups of each arg may not see the memberships just written yet
+  _refresh(args,dict([(arg,frozenset(get_groups(arg)) | frozenset([group])) for arg in args]))
+  return memberships
+  
+@rpc.accounted
+def remove_member(group,*args):
+  """
+  Remove the objs passed in args from the group
+  Returns the number of memberships that were removed or 0
+  """
+  group = utils.object_to_key(group)
+  args = [utils.object_to_key(arg) for arg in args]
+  memberships = [m.key() for m in utils.batch_get([_membership_key(group,arg) for arg in args]) if m is not None]
+  utils.batch_delete(memberships)
+  # the query for the groups of each arg may still return the memberships just deleted
+  _refresh(args,dict([(arg,[g for g in get_groups(arg) if g != group]) for arg in args]))
+  return len(memberships)
+  
+@rpc.accounted
+def get_members(group):
+  """
+  Return the keys of the objects directly in the group
+  """
+  query = models.GroupMembership.all(keys_only=True).filter('group',group)
+  return [utils.key_name_to_keys(k.name())[1] for k in utils.iter_all(query)]
+  
+@rpc.accounted
+def get_groups(obj):
+  """
+  Return the keys of the groups the obj is directly in
+  """
+  query = models.GroupMembership.all(keys_only=True).filter('member',obj)
+  return [utils.key_name_to_keys(k.name())[0] for k in utils.iter_all(query)]
+  
+@rpc.accounted
+def get_bitmap(obj):
+  """
+  Return the bitset (a byte string) of the bit ids of every permission the obj holds directly or through its groups.
+  Only available when USE_PERMISSION_BITMAPS is set, the bitset is cached in memcache when USE_MEMCACHE is set
+  """
+  obj = utils.object_to_key(obj)
+  return _bitmaps([obj])[obj]
+  
+@rpc.accounted
+def build_bitmaps():
+  """
+  Write the permission bitmaps of every bound obj from the existing bindings and inherited permissions, run this once
+  after turning on USE_PERMISSION_BITMAPS. Returns the number of bitmaps written
+  """
+  direct = {}
+  for batch in utils.iter_batches(models.PermissionBinding.all(keys_only=True),constants.MAX_BATCH_SIZE):
+    for k in batch:
+      if k.name() is not None:
+        permission, obj = utils.key_name_to_keys(k.name())
+        direct.setdefault(obj,set()).add(permission)
+  inherited = {}
+  for batch in utils.iter_batches(models.EffectivePermissions.all(),constants.MAX_BATCH_SIZE):
+    for e in batch:
+      inherited[_effective_obj(e.key())] = set(e.permissions)
+  held = set()
+  for permissions in direct.values()+inherited.values():
+    held.update(permissions)
+  ids = _permission_bits(list(held),True)
+  bitmaps = []
+  for obj in frozenset(direct.keys()+inherited.keys()):
+    bitmaps.append(models.PermissionBitmap(key_name=_bitmap_key(obj).name(),
+      direct=db.Blob(utils.to_bitset([ids[p] for p in direct.get(obj,[]) if p in ids])),
+      inherited=db.Blob(utils.to_bitset([ids[p] for p in inherited.get(obj,[]) if p in ids]))))
+  utils.batch_put(bitmaps)
+  _uncache_bitmaps(direct.keys()+inherited.keys())
+  return len(bitmaps)
+  
+@rpc.accounted
+def migrate_bindings():
+  """
+  Rewrite bindings created with auto-generated ids under their derived key names, dropping any duplicates.
+  Returns the number of legacy bindings that were rewritten
+  """
+  count = 0
+  for batch in utils.iter_batches(models.PermissionBinding.all(),constants.MAX_BATCH_SIZE):
+    legacy = [b for b in batch if b.key().name() is None]
+    # duplicates in later batches just overwrite the same named binding
+    named = {}
+    for b in legacy:
+      permission = models.PermissionBinding.permission.get_value_for_datastore(b)
+      obj = models.PermissionBinding.obj.get_value_for_datastore(b)
+      named[(permission,obj)] = models.PermissionBinding(key_name=_binding_key(permission,obj).name(),permission=permission,obj=obj)
+    utils.batch_put(named.values())
+    utils.batch_delete(legacy)
+    if constants.USE_MEMCACHE and len(named) > 0:
+      _client().delete_multi([BINDING_KEY(p,o) for p,o in named.keys()],seconds=constants.PERMISSION_LOCK_TIME)
+    lru.shared.delete_multi([BINDING_KEY(p,o) for p,o in named.keys()])
+    count += len(legacy)
+  return count
+  
+def _delete_bindings(permission):
+  # delete every binding of the permission a batch of keys at a time, returns the number deleted
+  count = 0
+  groups = []
+  query = models.PermissionBinding.all(keys_only=True).filter('permission',permission)
+  for bindings in utils.iter_batches(query,constants.MAX_BATCH_SIZE):
+    db.delete(bindings)
+    _uncache(permission,_bound_objs(bindings))
+    if constants.USE_PERMISSION_BITMAPS:
+      _set_direct_bits(permission,_bound_objs(bindings),False)
+    groups.extend(_groups(_bound_objs(bindings)))
+    count += len(bindings)
+  # members are refreshed once every batch is deleted, so none of the groups unbound here count as still holding it
+  _refresh_permission(permission,groups,False)
+  return count
+  
+def _binding_key(permission,obj):
+  # bindings are stored under a key name derived from the permission and obj keys
+  return db.Key.from_path(models.PermissionBinding.kind(),utils.keys_key_name(permission,obj))
+  
+def _membership_key(group,obj):
+  # memberships are stored under a key name derived from the group and obj keys
+  return db.Key.from_path(models.GroupMembership.kind(),utils.keys_key_name(group,obj))
+  
+def _effective_key(obj):
+  # the materialised inherited permissions of an obj are stored under a key name derived from the obj key
+  return db.Key.from_path(models.EffectivePermissions.kind(),utils.keys_key_name(obj))
+  
+def _effective_obj(effective_key):
+  # the reverse of _effective_key
+  return utils.key_name_to_keys(effective_key.name())[0]
+  
+def _groups(objs):
+  # the keys in objs that belong to groups
+  return [o for o in objs if o.kind() == models.Group.kind()]
+  
+def _ancestors(obj,parents):
+  # every group the obj is in, directly or through other groups. parents memoises get_groups across calls
+  found = set()
+  pending = [obj]
+  while len(pending) > 0:
+    o = pending.pop()
+    if o not in parents:
+      parents[o] = get_groups(o)
+    for group in parents[o]:
+      if group not in found:
+        found.add(group)
+        pending.append(group)
+  return found
+  
+def _descendants(groups):
+  # every obj in the groups, directly or through other groups
+  found = set()
+  pending = list(groups)
+  while len(pending) > 0:
+    for member in get_members(pending.pop()):
+      if member not in found:
+        found.add(member)
+        if member.kind() == models.Group.kind():
+          pending.append(member)
+  return found
+  
+def _refresh(objs,parents=None):
+  # recompute the materialised inherited permissions of the objs and of every member below them, called whenever a
+  # membership changes so that checks never have to walk the group graph. parents can hold the groups of objs whose
+  # memberships were just changed, as the membership and binding queries arent ancestor queries they may not see
+  # data written moments ago
+  affected = list(set(objs) | _descendants(_groups(objs)))
+  if len(affected) == 0:
+    return
+  parents = dict(parents or {})
+  bound = {}
+  stale = {}
+  inherited_bits = {}
+  for obj,effective in zip(affected,utils.batch_get([_effective_key(o) for o in affected])):
+    inherited = set()
+    for group in _ancestors(obj,parents):
+      if group not in bound:
+        bound[group] = [utils.key_name_to_keys(k.name())[0] for k in utils.iter_all(models.PermissionBinding.all(keys_only=True).filter('obj',group)) if k.name() is not None]
+      inherited.update(bound[group])
+    current = set(effective.permissions) if effective is not None else set()
+    if inherited == current:
+      continue
+    # only the difference is applied, in a transaction, so a concurrent change to another permission isnt lost
+    new = db.run_in_transaction(_update_effective,obj,inherited - current,current - inherited)
+    if new is not None:
+      inherited_bits[obj] = new
+    for permission in inherited ^ current:
+      stale.setdefault(permission,[]).append(obj)
+  _uncache_multi(stale)
+  if constants.USE_PERMISSION_BITMAPS:
+    _set_inherited_bits(inherited_bits)
+  
+def _refresh_permission(permission,groups,granted):
+  # a binding of the permission to the groups was made (granted) or removed, add or remove just that permission in the
+  # inherited permissions of every member below the groups rather than recomputing them all. Fan-outs larger than
+  # PERMISSION_REFRESH_INLINE are handed to task queue workers a batch at a time
+  if len(groups) == 0:
+    return
+  members = _descendants(groups)
+  if not granted and len(members) > 0:
+    # members below another group bound to the permission keep it. The bindings just removed can still be returned
+    # by the query so their groups are left out
+    query = models.PermissionBinding.all(keys_only=True).filter('permission',permission)
+    holders = [o for o in _groups(_bound_objs(utils.iter_all(query))) if o not in groups]
+    members -= _descendants(holders)
+  batches = utils.chunks(list(members))
+  if len(members) <= constants.PERMISSION_REFRESH_INLINE:
+    for objs in batches:
+      _update_inherited(permission,granted,objs)
+    return
+  from google.appengine.api import taskqueue
+  for objs in batches:
+    taskqueue.add(url=constants.PERMISSIONS_REFRESH_URL,params={'permission':str(permission),'granted':str(int(granted)),'obj':[str(o) for o in objs]})
+  
+def _update_inherited(permission,granted,objs):
+  # add (granted) or remove the permission in the inherited permissions of a batch of objs, one transaction per obj
+  change = [permission]
+  inherited = {}
+  for obj in objs:
+    new = db.run_in_transaction(_update_effective,obj,change if granted else [],[] if granted else change)
+    if new is not None:
+      inherited[obj] = new
+  _uncache(permission,inherited.keys())
+  if constants.USE_PERMISSION_BITMAPS:
+    _set_inherited_bits(inherited)
+  
+def _update_effective(obj,added,removed):
+  # transaction body: add and remove permissions in the stored inherited permissions of the obj, returns the new list
+  # of permissions or None if nothing changed
+  key = _effective_key(obj)
+  effective = db.get(key)
+  current = effective.permissions if effective is not None else []
+  new = [p for p in current if p not in removed] + [p for p in added if p not in current]
+  if new == current:
+    return None
+  if len(new) > 0:
+    models.EffectivePermissions(key_name=key.name(),permissions=new).put()
   else:
-    return True
+    db.delete(key)
+  return new
+  
+def _bitmap_key(obj):
+  # the permission bitmap of an obj is stored under a key name derived from the obj key
+  return db.Key.from_path(models.PermissionBitmap.kind(),utils.keys_key_name(obj))
+  
+def _bitmaps(objs):
+  # return {obj key: bitset of every permission the obj holds}, using memcache where possible
+  bitmaps = {}
+  if constants.USE_MEMCACHE and len(objs) > 0:
+    cached = _client().get_multi([BITMAP_KEY(o) for o in objs])
+    for o in objs:
+      if BITMAP_KEY(o) in cached:
+        bitmaps[o] = cached[BITMAP_KEY(o)]
+  missing = list(frozenset([o for o in objs if o not in bitmaps]))
+  if len(missing) > 0:
+    for o,bitmap in zip(missing,utils.batch_get([_bitmap_key(o) for o in missing])):
+      bitmaps[o] = utils.union_bits(bitmap.direct,bitmap.inherited) if bitmap is not None else ''
+    if constants.USE_MEMCACHE:
+      _client().add_multi(dict([(BITMAP_KEY(o),bitmaps[o]) for o in missing]),time=constants.PERMISSION_CACHE_TIME)
+  return bitmaps
+  
+def _uncache_bitmaps(objs):
+  # drop the cached bitmaps of the objs, locked like the has_permission results (see _uncache)
+  if constants.USE_MEMCACHE and len(objs) > 0:
+    _client().delete_multi([BITMAP_KEY(o) for o in objs],seconds=constants.PERMISSION_LOCK_TIME)
+  
+def _permission_bits(permissions,allocate=False):
+  # return {permission key: bit id} for the permissions that have one. With allocate permissions that exist but have no
+  # bit id yet are given one, only writes allocate so checks never start transactions (a permission without a bit id
+  # isnt in any bitmap)
+  permissions = [utils.object_to_key(p) for p in permissions]
+  bits = {}
+  if constants.USE_MEMCACHE and len(permissions) > 0:
+    cached = _client().get_multi([BIT_KEY(p) for p in permissions])
+    for p in permissions:
+      if BIT_KEY(p) in cached:
+        bits[p] = cached[BIT_KEY(p)]
+  missing = list(frozenset([p for p in permissions if p not in bits]))
+  if len(missing) > 0:
+    fetched = {}
+    for p,permission in zip(missing,utils.batch_get(missing)):
+      if permission is None or (permission.bit is None and not allocate):
+        continue
+      bits[p] = permission.bit if permission.bit is not None else _allocate_bit(p)
+      fetched[BIT_KEY(p)] = bits[p]
+    if constants.USE_MEMCACHE:
+      _client().set_multi(fetched)
+  return bits
+  
+def _allocate_bit(permission):
+  # give the permission the next bit id from the counter, returns the id the permission ended up with
+  def next_bit():
+    counter = models.PermissionCounter.get_by_key_name('bits') or models.PermissionCounter(key_name='bits')
+    counter.next += 1
+    counter.put()
+    return counter.next - 1
+  def assign(bit):
+    p = db.get(permission)
+    if p.bit is None:
+      p.bit = bit
+      p.put()
+    return p.bit
+  return db.run_in_transaction(assign,db.run_in_transaction(next_bit))
+  
+def _update_bitmap(obj,field,update):
+  # transaction body: replace one of the bitsets of the obj's bitmap with update(old bitset)
+  key = _bitmap_key(obj)
+  bitmap = db.get(key) or models.PermissionBitmap(key_name=key.name())
+  setattr(bitmap,field,db.Blob(update(getattr(bitmap,field))))
+  bitmap.put()
+  
+def _set_direct_bits(permission,objs,value):
+  # set (or clear) the bit of the permission in the direct bitset of each obj, one transaction per obj
+  permission = utils.object_to_key(permission)
+  # clearing a bit the permission was never given has nothing to do
+  bits = _permission_bits([permission],value)
+  if permission in bits:
+    for obj in objs:
+      db.run_in_transaction(_update_bitmap,obj,'direct',lambda old: utils.set_bit(old,bits[permission],value))
+    _uncache_bitmaps(objs)
+  
+def _set_inherited_bits(inherited):
+  # replace the inherited bitset of each obj, inherited is a dict of {obj key: permission keys}
+  held = set()
+  for permissions in inherited.values():
+    held.update(permissions)
+  ids = _permission_bits(list(held),True)
+  for obj,permissions in inherited.items():
+    new = utils.to_bitset([ids[p] for p in permissions if p in ids])
+    db.run_in_transaction(_update_bitmap,obj,'inherited',lambda old: new)
+  _uncache_bitmaps(inherited.keys())
+  
+def _trie_obj(obj):
+  # the leaf key of an obj in the trie
+  return str(utils.object_to_key(obj)) if obj is not None else ''
+  
+def _trie_segments(action):
+  # the trie path of an action, normalised the same way as key names so lookups ignore case and spaces
+  action = utils.key_name(action)
+  return action.split('.') if action else []
+  
+def _trie_root(root,prefix):
+  # the trie node for the action prefix or an empty node
+  node = root
+  for segment in _trie_segments(prefix):
+    node = node.get(segment,{})
+  return node
+  
+def _trie_leaves(node):
+  # every leaf dict at or below the node
+  leaves = []
+  pending = [node]
+  while len(pending) > 0:
+    node = pending.pop()
+    for segment,child in node.items():
+      if segment == TRIE_LEAF:
+        leaves.append(child)
+      else:
+        pending.append(child)
+  return leaves
+  
+def _trie_leaf(root,action,obj):
+  # the key name of the permission for the action and obj, or None if there isnt one
+  return _trie_root(root,action).get(TRIE_LEAF,{}).get(_trie_obj(obj))
+  
+def _trie_insert(root,action,obj,key_name):
+  node = root
+  for segment in _trie_segments(action):
+    node = node.setdefault(segment,{})
+  node.setdefault(TRIE_LEAF,{})[_trie_obj(obj)] = key_name
+  
+def _trie_remove(root,action,obj):
+  _trie_root(root,action).get(TRIE_LEAF,{}).pop(_trie_obj(obj),None)
+  
+def _find_by_key_name(prefix,obj):
+  # find without the trie: permission key names start with the normalised action, so the permissions under the prefix
+  # are in one range of keys. The range also holds longer segments and other objs, those are filtered out here
+  prefix = utils.key_name(prefix)
+  query = models.Permission.all()
+  if prefix:
+    query.filter('__key__ >=',db.Key.from_path(models.Permission.kind(),prefix))
+    query.filter('__key__ <',db.Key.from_path(models.Permission.kind(),prefix+u'\ufffd'))
+  found = []
+  for permission in utils.iter_all(query):
+    action = utils.key_name(permission.action)
+    if prefix and action != prefix and not action.startswith(prefix+'.'):
+      continue
+    if obj is not None and _trie_obj(models.Permission.obj.get_value_for_datastore(permission)) != _trie_obj(obj):
+      continue
+    found.append(permission)
+  return found
+  
+def _build_trie():
+  # build the trie from every permission in the datastore
+  root = {}
+  for permission in utils.iter_all(models.Permission.all()):
+    _trie_insert(root,permission.action,models.Permission.obj.get_value_for_datastore(permission),permission.key().name())
+  return root
+  
+def _load_trie():
+  # the trie of known permissions, {segment: {segment: ..., TRIE_LEAF: {obj key or '': key name}}}
+  # kept in memcache and copied into this process, the copy is only reloaded when the version number changes.
+  # without USE_MEMCACHE the trie is rebuilt from the datastore on every call
+  if not constants.USE_MEMCACHE:
+    return _build_trie()
+  version = _client().get(TRIE_VERSION_KEY)
+  if version is not None and version == _trie['version']:
+    return _trie['root']
+  root = _client().get(TRIE_KEY)
+  if root is None:
+    root = _build_trie()
+    _client().add(TRIE_KEY,root,time=constants.PERMISSION_CACHE_TIME)
+  if version is None:
+    version = uuid.uuid4().hex
+    _client().add(TRIE_VERSION_KEY,version)
+  _trie['version'] = version
+  _trie['root'] = root
+  return root
+  
+def _update_trie(update):
+  # apply update(root) to the trie in memcache with compare-and-set and change the version number,
+  # the trie is dropped (and rebuilt by the next reader) if it cant be updated or is too big to update
+  if not constants.USE_MEMCACHE:
+    return
+  client = _client()
+  for i in range(constants.MEMCACHE_CAS_RETRIES):
+    root = client.gets(TRIE_KEY)
+    if root is None:
+      break
+    # a trie too big for one memcache item is stored in chunks (gets returns the chunk manifest) and cant be updated
+    # with cas, so it is dropped and rebuilt by the next reader instead
+    if not isinstance(root,dict):
+      client.delete(TRIE_KEY)
+      break
+    update(root)
+    try:
+      if client.cas(TRIE_KEY,root,time=constants.PERMISSION_CACHE_TIME):
+        break
+    except ValueError:
+      # the updated trie has grown too big for one memcache item
+      client.delete(TRIE_KEY)
+      break
+  else:
+    client.delete(TRIE_KEY)
+  # versions are random rather than counted so a flushed memcache cant hand out a number a process has already seen
+  client.set(TRIE_VERSION_KEY,uuid.uuid4().hex)
+  
+def _client():
+  # the memcache client for this thread, values are encoded with utils.codec
+  if not hasattr(_local,'client'):
+    _local.client = cache.Client()
+  return _local.client
+  
+def _bound_objs(binding_keys):
+  # recover the bound obj keys from a list of binding keys (legacy id keys are skipped)
+  return [utils.key_name_to_keys(k.name())[1] for k in binding_keys if k.name() is not None]
+  
+def _uncache(permission,objs):
+  # drop the cached has_permission results for the permission and each of the objs, see _uncache_multi
+  _uncache_multi({permission:objs})
+  
+def _uncache_multi(stale):
+  # drop the cached has_permission results of stale, a dict of {permission: objs}, and anything cached that depends on
+  # them with one delete per cache. The results stay locked for PERMISSION_LOCK_TIME seconds so checks already in flight
+  # cant add them back. Dependants are kept in memcache so there are none to drop without USE_MEMCACHE
+  keys = []
+  dependants = set()
+  for permission,objs in stale.items():
+    permission = utils.object_to_key(permission)
+    objs = [utils.object_to_key(o) for o in objs]
+    keys.extend([BINDING_KEY(permission,o) for o in objs])
+    if len(objs) > 0:
+      dependants.add(permission)
+      dependants.update(objs)
+  if len(keys) == 0:
+    return
+  if constants.USE_MEMCACHE:
+    _client().delete_multi(keys,seconds=constants.PERMISSION_LOCK_TIME)
+    utils.remove_dependants(list(dependants))
+  lru.shared.delete_multi(keys)
     
 
-  
\ No newline at end of file
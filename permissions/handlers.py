@@ -0,0 +1,28 @@
+"""
+Request handlers for the permissions module. Map constants.PERMISSIONS_REFRESH_URL to this script in app.yaml (admin only)
+so the task queue can apply group binding changes to large groups.
+"""
+import logging
+import constants
+from permissions import functions
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp.util import run_wsgi_app
+
+class RefreshHandler(webapp.RequestHandler):
+  """
+  Task queue worker that adds or removes a permission in the inherited permissions of a batch of group members
+  """
+  def post(self):
+    permission = db.Key(self.request.get('permission'))
+    objs = [db.Key(o) for o in self.request.get_all('obj')]
+    functions._update_inherited(permission,self.request.get('granted') == '1',objs)
+    logging.info("pglib.permissions: refreshed the inherited permissions of "+str(len(objs))+" objects")
+    
+application = webapp.WSGIApplication([(constants.PERMISSIONS_REFRESH_URL, RefreshHandler)])
+
+def main():
+  run_wsgi_app(application)
+  
+if __name__ == '__main__':
+  main()
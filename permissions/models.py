@@ -7,6 +7,7 @@ class Permission(db.Model):
   action = db.StringProperty(required=True)
   obj = db.ReferenceProperty(required=False)
   desc = db.TextProperty(required=False) #optional
+  bit = db.IntegerProperty(required=False) # small dense id, allocated when the permission is first used in a bitmap
   
   def __eq__(self, other):
     if other is None:
@@ -30,4 +31,39 @@ class PermissionBinding(db.Model):
   
   def __str__(self):
     return "Permission Binding: "+str(permission)+" "+str(obj)
-  
\ No newline at end of file
+  
+class Group(db.Model):
+  """
+  A named collection of objects (which can include other groups), permissions bound to a group are held by all of its members
+  """
+  name = db.StringProperty(required=True)
+  desc = db.TextProperty(required=False) #optional
+  
+  def __str__(self):
+    return "Group: "+self.name
+  
+class GroupMembership(db.Model):
+  """
+  A one-to-many membership between a group and another object
+  """
+  group = db.ReferenceProperty(reference_class=Group,required=True,collection_name='memberships')
+  member = db.ReferenceProperty(required=True,collection_name='group_memberships')
+  
+class EffectivePermissions(db.Model):
+  """
+  The materialised set of permissions an object holds through its groups, stored under a key name derived from the object key
+  """
+  permissions = db.ListProperty(db.Key)
+  
+class PermissionBitmap(db.Model):
+  """
+  Compact bitsets of the bit ids of the permissions an object holds directly and through its groups, stored under a key name derived from the object key
+  """
+  direct = db.BlobProperty(default='')
+  inherited = db.BlobProperty(default='')
+  
+class PermissionCounter(db.Model):
+  """
+  Hands out the bit ids of permissions
+  """
+  next = db.IntegerProperty(required=True,default=0)
@@ -1,8 +1,21 @@
-import functions
-import exceptions
+import lazy
 
 __all__ = ['functions']
 
-get = functions.get
-set = functions.set
-load = functions.load
\ No newline at end of file
+# public names are imported from the submodules on first use, see lazy.py
+lazy.install(__name__, {
+  'models': ('models', None),
+  'functions': ('functions', None),
+  'exceptions': ('exceptions', None),
+  'get': ('functions', 'get'),
+  'get_async': ('functions', 'get_async'),
+  'get_multi': ('functions', 'get_multi'),
+  'get_multi_async': ('functions', 'get_multi_async'),
+  'set': ('functions', 'set'),
+  'set_async': ('functions', 'set_async'),
+  'set_write_behind': ('functions', 'set_write_behind'),
+  'flush': ('functions', 'flush'),
+  'load': ('functions', 'load'),
+  'reset': ('functions', 'reset'),
+  'middleware': ('functions', 'middleware'),
+})
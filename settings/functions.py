@@ -1,71 +1,485 @@
 import models
 import logging
+import os
+import threading
+import time
 import types
+import uuid
 import utils
+from utils import cache
+from utils import lru
+from utils import rpc
+import constants
 from google.appengine.api import users
-from google.appengine.api import memcache
+from google.appengine.ext import db
 
-logging.info(str(type(models)))
 # IMPORTANT: this module ignores the USE_MEMCACHE constant and always caches
   
 # memcache key and db key_name generators
 USER_KEY=lambda c,k: "user_"+c.nickname()+"_"+k
 GLOBAL_KEY=lambda k: "global_"+k
 
+# per-thread state: the memcache client, the request cache of values already looked up during this request and the id
+# of the request it belongs to
+_local = threading.local()
+# request cache marker for a setting known not to exist
+_MISSING = object()
+# memcache value stored for a setting known not to exist
+TOMBSTONE = "pglib.settings.missing"
+# memcache keys for the set of settings with write-behind values waiting to be flushed, and each waiting value
+PENDING_KEY = "pglib.settings.pending"
+PENDING_VALUE_KEY=lambda k: "pending_"+k
+# property names load cant store as they are Setting properties or constructor arguments
+RESERVED_PROPERTIES = frozenset(['index','owner','is_global','key_name','parent'])
+# the last write-behind window a flush task was queued for by this process
+_flush_window = {'window':None}
+# memcache key of the generation of the global settings, a (stamp, {key: time written}) tuple of a random stamp and the
+# global settings written recently, changed by every write to a global setting
+GENERATION_KEY = "pglib.settings.generation"
+# this process's snapshot of every global setting as a (generation, time checked, {key: value}) tuple, replaced whole
+_snapshot = {'snapshot':None}
+_snapshot_lock = threading.Lock()
+
+@rpc.accounted
 def get(index, user_first=False, default={}):
   """
   Get and return a settings value for the specified index. If user_first then search for a user value to override the global value first.
-  Use memcache to store query results for speedups in future.
+  Use memcache to store query results for speedups in future, repeat lookups during the same request are answered from the request cache.
+  """
+  return get_async(index,user_first,default).get_result()
+  
+@rpc.accounted
+def get_async(index, user_first=False, default={}):
+  """
+  Start looking up a settings value and return a utils.Future of the value get would return.
+  Lookups started together share their memcache and datastore round-trips when waited on with utils.wait_all
+  """
+  return utils.Future(lambda results: results[index],get_multi_async([index],user_first,default))
+   
+@rpc.accounted
+def get_multi(indexes, user_first=False, default={}):
+  """
+  Get the settings values for a list of indexes with one memcache get_multi and at most one datastore get.
+  Returns a dict of {index: value}, user values take precedence over global values when user_first is set and indexes
+  that cant be found map to the default.
+  """
+  return get_multi_async(indexes,user_first,default).get_result()
+  
+@rpc.accounted
+def get_multi_async(indexes, user_first=False, default={}):
+  """
+  Start looking up the settings values for a list of indexes and return a utils.Future of the dict get_multi would return
   """
-  index = str(index)
   current_user = users.get_current_user()
-  m_client = memcache.Client()
-  # find the user setting first (if user_first)
+  keys = [GLOBAL_KEY(str(index)) for index in indexes]
   if user_first:
-    key = USER_KEY(current_user,index)
-    u_value = m_client.get(key)
-    if u_value:
-      return u_value
-    u_setting = models.Setting.get_by_key_name(key)
-    if u_setting:
-      u_value = utils.expando_prop_dict(u_setting)
-      m_client.set(key,u_value)
-      return u_value
-  # try to retrieve the global setting using a calculated key_name
-  key = GLOBAL_KEY(index)
-  g_value = m_client.get(key)
-  if g_value:
-    return g_value
-  else:
-    g_setting = models.Setting.get_by_key_name(key)
-    if g_setting:
-      g_value = utils.expando_prop_dict(g_setting)
-      m_client.set(key,g_value)
-      return g_value
-  logging.warning("pglib.settings: could not find setting with index: "+GLOBAL_KEY(index)+" or "+USER_KEY(current_user,index))
-  return default
+    keys.extend([USER_KEY(current_user,str(index)) for index in indexes])
+  def resolve(found):
+    results = {}
+    missing = []
+    for index in indexes:
+      value = _MISSING
+      if user_first:
+        value = found[USER_KEY(current_user,str(index))]
+      if value is _MISSING:
+        value = found[GLOBAL_KEY(str(index))]
+      if value is _MISSING:
+        missing.append(str(index))
+        results[index] = default
+      else:
+        results[index] = dict(value)
+    if len(missing) > 0:
+      logging.warning("pglib.settings: could not find settings with indexes: "+", ".join(missing))
+    return results
+  return utils.Future(resolve,_lookup_multi_async(keys))
    
-def set(index, is_global=False, **kwargs):
+@rpc.accounted
+def set(index, is_global=False, replace=False, merge=False, **kwargs):
   """
   Set both the value of the datastore settings object and also the memcache record
+  By default the new properties are merged into the stored setting without a transaction. With replace the setting is
+  overwritten by a blind put of just the given properties (no read), with merge the read-modify-write runs in a transaction
+  so concurrent sets dont lose each others properties.
+  """
+  return set_async(index,is_global,replace,merge,**kwargs).get_result()
+  
+@rpc.accounted
+def set_async(index, is_global=False, replace=False, merge=False, **kwargs):
+  """
+  Return a utils.Future of the Setting that set would return. Only the first datastore rpc is started here (none at all
+  with merge), the rest of the write and the memcache update happen when the Future is waited on, so until then the
+  setting may be unwritten and readers may see the old value. Always wait on the result
   """
   index = str(index)
   current_user = users.get_current_user()
   key = GLOBAL_KEY(index) if is_global else USER_KEY(current_user,index)
-  m_client = memcache.Client()
-  #m_client.delete(m_index)
+  def written(s):
+    value = utils.expando_prop_dict(s)
+    _client().set(key,value)
+    _refresh_stale({key:value})
+    _request_cache()[key] = value
+    _cache_locally({key:value})
+    utils.remove_dependants([s.key()])
+    if is_global:
+      _bump_generation([key])
+    return s
+  if replace:
+    s = models.Setting(key_name=key,index=index,is_global=is_global,**kwargs)
+    return utils.Future(lambda k: written(s),db.put_async(s))
+  if merge:
+    return utils.Future(lambda: written(db.run_in_transaction(_merge_setting,key,index,is_global,kwargs)))
+  def write(found):
+    s = found[0]
+    if s:
+      s = utils.update_expando(s,kwargs)
+    else:
+      s = models.Setting(key_name=key,index=index,is_global=is_global,**kwargs)
+    return utils.Future(lambda k: written(s),db.put_async(s))
+  return utils.Future(write,db.get_async([db.Key.from_path(models.Setting.kind(),key)]))
+  
+@rpc.accounted
+def set_write_behind(index, is_global=False, **kwargs):
+  """
+  Set a settings value in memcache straight away and write it to the datastore later. Repeated writes to the same setting
+  within SETTINGS_WRITE_BEHIND_WINDOW seconds are coalesced into one datastore put, made in a batch by a task queue worker
+  (see flush). Values waiting to be flushed only live in memcache so use settings.set for anything that must not be lost.
+  Global settings are written straight away when USE_SETTINGS_SNAPSHOT is set, as readers answer them from their snapshot.
+  Returns the value that will be written
+  """
+  index = str(index)
+  current_user = users.get_current_user()
+  key = GLOBAL_KEY(index) if is_global else USER_KEY(current_user,index)
+  value = _lookup_multi_async([key]).get_result()[key]
+  value = dict(value) if value is not _MISSING else {}
+  value.update(kwargs)
+  if is_global and constants.USE_SETTINGS_SNAPSHOT:
+    # snapshots are loaded from the datastore and never see values waiting in memcache
+    return utils.expando_prop_dict(set(index,is_global,**value))
+  if len(_client().set_multi({key:value,PENDING_VALUE_KEY(key):(index,is_global,value)},time=constants.SETTINGS_PENDING_TIME)) > 0 or not _add_pending([key]):
+    # cant queue the write so make it now
+    return utils.expando_prop_dict(set(index,is_global,**value))
+  _refresh_stale({key:value})
+  _request_cache()[key] = value
+  _cache_locally({key:value})
+  window = int(time.time()) // constants.SETTINGS_WRITE_BEHIND_WINDOW
+  if _flush_window['window'] != window:
+    from google.appengine.api import taskqueue
+    try:
+      taskqueue.add(url=constants.SETTINGS_FLUSH_URL,name="pglib-settings-flush-"+str(window),countdown=constants.SETTINGS_WRITE_BEHIND_WINDOW)
+    except (taskqueue.TaskAlreadyExistsError,taskqueue.TombstonedTaskError):
+      # another request already queued the flush for this window
+      pass
+    _flush_window['window'] = window
+  return value
+  
+@rpc.accounted
+def flush():
+  """
+  Write every pending write-behind setting to the datastore in batches, returns the number of settings written.
+  This is what the task queue worker runs, it can also be called directly as a durability hook
+  """
+  # take the pending set with cas, keys added while flushing are left for the next flush and keys that cant be written are put back
+  for i in range(constants.MEMCACHE_CAS_RETRIES):
+    pending = _client().gets(PENDING_KEY)
+    if not pending:
+      return 0
+    if _client().cas(PENDING_KEY,frozenset()):
+      break
+  else:
+    return 0
+  count = 0
+  remaining = list(pending)
+  try:
+    while len(remaining) > 0:
+      keys = remaining[:constants.MAX_BATCH_SIZE]
+      values = _client().get_multi([PENDING_VALUE_KEY(k) for k in keys])
+      changed = []
+      for key,s in zip(keys,models.Setting.get_by_key_name(keys)):
+        if PENDING_VALUE_KEY(key) not in values:
+          logging.warning("pglib.settings: lost write-behind value for setting: "+key)
+          continue
+        index, is_global, props = values[PENDING_VALUE_KEY(key)]
+        if s:
+          s = utils.update_expando(s,props)
+        else:
+          s = models.Setting(key_name=key,index=index,is_global=is_global,**props)
+        changed.append(s)
+      utils.batch_put(changed)
+      remaining = remaining[len(keys):]
+      if len(changed) > 0:
+        utils.remove_dependants(changed)
+        if len([c for c in changed if c.is_global]) > 0:
+          _bump_generation([c.key().name() for c in changed if c.is_global])
+      count += len(changed)
+  except:
+    # put back the keys whose batch wasnt stored so the next flush (or the task queue retry) writes them.
+    # a bare except so the keys are put back on a DeadlineExceededError too
+    if not _add_pending(remaining):
+      logging.error("pglib.settings: could not requeue write-behind settings: "+", ".join(remaining))
+    raise
+  return count
+  
+@rpc.accounted
+def load(yaml_file, is_global=True):
+  """
+  Load a series of settings from a yaml file (a filename or an open file). Each document in the file is a mapping of
+  index: properties, where properties is either a mapping of setting properties or a plain value which is stored as 'value'.
+  Documents are read one at a time and compared against the stored settings in batches, only new or changed settings are written.
+  Raises ValueError for a document that isnt a mapping or a property name that is reserved (see RESERVED_PROPERTIES),
+  documents before it have already been loaded. Returns a dict of counts {'created': n, 'updated': n, 'unchanged': n}
+  """
+  # yaml is only needed here so it isnt imported with the module
+  import yaml
+  counts = {'created':0, 'updated':0, 'unchanged':0}
+  stream = open(yaml_file) if isinstance(yaml_file,types.StringTypes) else yaml_file
+  try:
+    for number,document in enumerate(yaml.safe_load_all(stream)):
+      if document is None:
+        continue
+      if not isinstance(document,dict):
+        raise ValueError("pglib.settings: yaml document "+str(number+1)+" is a "+type(document).__name__+", not a mapping of index: properties")
+      for chunk in utils.chunks(document.items(),constants.MAX_BATCH_SIZE):
+        _load_settings(chunk,is_global,counts)
+  finally:
+    if stream is not yaml_file:
+      stream.close()
+  return counts
+  
+def reset():
+  """
+  Empty the request cache. It is emptied automatically when a new request starts, call this to see settings changed by
+  other instances during a long request (or wrap the application with middleware where requests cant be told apart)
+  """
+  _local.values = {}
+  _local.request = _request_id()
+  
+def middleware(app):
+  """
+  Wrap a WSGI application so the request cache is reset at the start and end of every request
+  """
+  def wrapped_app(environ, start_response):
+    reset()
+    try:
+      return app(environ, start_response)
+    finally:
+      reset()
+  return wrapped_app
+  
+def _add_pending(keys):
+  # add the keys to the set of settings waiting to be flushed with cas so concurrent writers dont lose each other,
+  # returns False if the set couldnt be updated
+  keys = frozenset(keys)
+  for i in range(constants.MEMCACHE_CAS_RETRIES):
+    pending = _client().gets(PENDING_KEY)
+    if pending is None:
+      if _client().add(PENDING_KEY,keys):
+        return True
+    elif keys <= pending or _client().cas(PENDING_KEY,pending | keys):
+      return True
+  return False
+  
+def _client():
+  # the memcache client for this thread, created once and reused. Values too big for one memcache item are split into chunks
+  if not hasattr(_local,'client'):
+    _local.client = cache.Client()
+  return _local.client
+  
+def _request_cache():
+  # the dict of values looked up during the current request, emptied when the thread starts serving another request
+  if not hasattr(_local,'values') or _local.request != _request_id():
+    reset()
+  return _local.values
+  
+def _request_id():
+  # the id App Engine gives the request being served, or the environment dict itself where there is no id (e.g. under
+  # the test runner) so the cache only lasts until the environment is replaced
+  return os.environ.get('REQUEST_LOG_ID') or os.environ.get('REQUEST_ID_HASH') or id(os.environ)
+  
+def _global_snapshot():
+  # return the snapshot {key: value} of every global setting, or None when USE_SETTINGS_SNAPSHOT is off. The generation
+  # in memcache is checked at most every SETTINGS_SNAPSHOT_CHECK_TIME seconds and the settings are only queried again
+  # when it has changed, so most reads cost no rpcs at all
+  if not constants.USE_SETTINGS_SNAPSHOT:
+    return None
+  snapshot = _snapshot['snapshot']
+  if snapshot is not None and time.time() < snapshot[1] + constants.SETTINGS_SNAPSHOT_CHECK_TIME:
+    return snapshot[2]
+  # one thread refreshes the snapshot while the others carry on with the one they have
+  if not _snapshot_lock.acquire(snapshot is None):
+    return snapshot[2]
+  try:
+    snapshot = _snapshot['snapshot']
+    if snapshot is not None and time.time() < snapshot[1] + constants.SETTINGS_SNAPSHOT_CHECK_TIME:
+      return snapshot[2]
+    # read the generation before the query so a write made during the reload is picked up by the next check
+    generation = _client().get(GENERATION_KEY)
+    if generation is None:
+      generation = (uuid.uuid4().hex,{})
+      if not _client().add(GENERATION_KEY,generation):
+        generation = _client().get(GENERATION_KEY) or generation
+    stamp, written = _generation_parts(generation)
+    if snapshot is not None and snapshot[0] == stamp:
+      values = snapshot[2]
+    else:
+      query = models.Setting.all().filter('is_global =',True)
+      values = dict([(s.key().name(),utils.expando_prop_dict(s)) for s in utils.iter_all(query)])
+      # the query isnt an ancestor query so it may not see the latest writes yet, those are read back by key
+      keys = written.keys()
+      for k,s in zip(keys,models.Setting.get_by_key_name(keys)):
+        if s is not None and s.is_global:
+          values[k] = utils.expando_prop_dict(s)
+        else:
+          values.pop(k,None)
+    _snapshot['snapshot'] = (stamp,time.time(),values)
+    return values
+  finally:
+    _snapshot_lock.release()
+  
+def _bump_generation(keys):
+  # tell every process its global settings snapshot is out of date, a random stamp cant repeat an old one after eviction.
+  # the keys written are kept with the stamp for SETTINGS_SNAPSHOT_RECHECK_TIME seconds so reloads read them by key
+  if not constants.USE_SETTINGS_SNAPSHOT:
+    return
+  now = time.time()
+  for i in range(constants.MEMCACHE_CAS_RETRIES):
+    current = _client().gets(GENERATION_KEY)
+    written = dict([(k,t) for k,t in _generation_parts(current)[1].items() if t > now - constants.SETTINGS_SNAPSHOT_RECHECK_TIME])
+    written.update(dict([(k,now) for k in keys]))
+    if current is None:
+      if _client().add(GENERATION_KEY,(uuid.uuid4().hex,written)):
+        break
+    elif _client().cas(GENERATION_KEY,(uuid.uuid4().hex,written)):
+      break
+  else:
+    # the other writers keys may be lost but the stamp still changes
+    _client().set(GENERATION_KEY,(uuid.uuid4().hex,dict([(k,now) for k in keys])))
+  snapshot = _snapshot['snapshot']
+  if snapshot is not None:
+    _snapshot['snapshot'] = (snapshot[0],0,snapshot[2])
+  
+def _generation_parts(generation):
+  # (stamp, {key: time written}) from the value stored under GENERATION_KEY (the json codec turns the tuple into a list)
+  if isinstance(generation,(tuple,list)) and len(generation) == 2:
+    return generation[0], dict(generation[1])
+  return generation, {}
+  
+def _refresh_stale(values):
+  # overwrite the stale copies of {key: value} that wait_multi hands out while a key is being filled, so a write (or a
+  # setting created after its tombstone was cached) is never followed by the old value
+  if constants.USE_CACHE_LEASES:
+    _client().set_multi(dict([(cache.STALE_KEY(k),v) for k,v in values.items()]),time=constants.CACHE_STALE_TIME)
+  
+def _cache_locally(values):
+  # copy {key: value or TOMBSTONE} into the instance memory cache, or drop the keys from it when it isnt in use so
+  # nothing stale is left behind if it is turned back on
+  if constants.USE_LOCAL_CACHE:
+    lru.shared.set_multi(values)
+  else:
+    lru.shared.delete_multi(values.keys())
+  
+def _merge_setting(key, index, is_global, props):
+  # transaction body: merge props into the stored setting (or create it) and return it
   s = models.Setting.get_by_key_name(key)
   if s:
-    s = utils.update_expando(s,kwargs)
+    s = utils.update_expando(s,props)
   else:
-    s = models.Setting(key_name=key,index=index,is_global=is_global,**kwargs)
+    s = models.Setting(key_name=key,index=index,is_global=is_global,**props)
   s.put()
-  m_client.set(key,utils.expando_prop_dict(s))
   return s
   
-def load(yaml_file):
-  """
-  load a sreies of settings from a yaml file
-  """
-  #TODO: this function...
-  return None
\ No newline at end of file
+def _load_settings(items, is_global, counts):
+  # store a batch of (index, properties) pairs with one batch get and one batch put, updating counts
+  current_user = users.get_current_user()
+  keys = [GLOBAL_KEY(str(index)) if is_global else USER_KEY(current_user,str(index)) for index,props in items]
+  changed = []
+  values = {}
+  for (index,props),key,s in zip(items,keys,models.Setting.get_by_key_name(keys)):
+    if isinstance(props,dict):
+      props = dict([(str(k),v) for k,v in props.items()])
+    else:
+      props = {'value':props}
+    reserved = [k for k in props if k in RESERVED_PROPERTIES or k.startswith('_')]
+    if len(reserved) > 0:
+      raise ValueError("pglib.settings: setting "+str(index)+" uses reserved property names: "+", ".join(reserved))
+    if s is None:
+      s = models.Setting(key_name=key,index=str(index),is_global=is_global,**props)
+      changed.append(s)
+      counts['created'] += 1
+    elif utils.extract(utils.expando_prop_dict(s),props.keys()) != props:
+      s = utils.update_expando(s,props)
+      changed.append(s)
+      counts['updated'] += 1
+    else:
+      counts['unchanged'] += 1
+    values[key] = utils.expando_prop_dict(s)
+  utils.batch_put(changed)
+  _client().set_multi(values)
+  _refresh_stale(values)
+  _request_cache().update(values)
+  _cache_locally(values)
+  if len(changed) > 0:
+    utils.remove_dependants(changed)
+    if is_global:
+      _bump_generation([s.key().name() for s in changed])
+  
+def _lookup_multi_async(keys):
+  # return a Future of {key: settings value or _MISSING} for the keys, checking the request cache, then memcache with a
+  # single get_multi, then the datastore with a single batch get for whatever is left
+  values = _request_cache()
+  results = utils.extract(values,keys)
+  # the snapshot holds every global setting so a global key it doesnt have is missing
+  snapshot = _global_snapshot()
+  if snapshot is not None:
+    for k in keys:
+      if k not in results and k.startswith(GLOBAL_KEY("")):
+        results[k] = snapshot.get(k,_MISSING)
+  if constants.USE_LOCAL_CACHE:
+    for k,value in lru.shared.get_multi([k for k in keys if k not in results]).items():
+      results[k] = _MISSING if value == TOMBSTONE else value
+  def from_datastore(missing,leased,settings):
+    fetched = {}
+    tombstones = {}
+    for k,setting in zip(missing,settings):
+      if setting:
+        fetched[k] = utils.expando_prop_dict(setting)
+        results[k] = fetched[k]
+      else:
+        tombstones[k] = TOMBSTONE
+        results[k] = _MISSING
+    if constants.USE_CACHE_LEASES:
+      _client().fill_multi(fetched,leased)
+      _client().fill_multi(tombstones,leased,time=constants.SETTINGS_MISSING_CACHE_TIME)
+    else:
+      if len(fetched) > 0:
+        _client().set_multi(fetched)
+      # remember missing settings too, settings.set overwrites the tombstone when the setting is created
+      if len(tombstones) > 0:
+        _client().set_multi(tombstones,time=constants.SETTINGS_MISSING_CACHE_TIME)
+    _cache_locally(fetched)
+    _cache_locally(tombstones)
+    values.update(results)
+    return results
+  def from_memcache(cached):
+    for k,value in cached.items():
+      if value == TOMBSTONE:
+        results[k] = _MISSING
+      elif value:
+        results[k] = value
+    _cache_locally(cached)
+    missing = list(frozenset([k for k in keys if k not in results]))
+    leased = []
+    if constants.USE_CACHE_LEASES:
+      # the keys leased by other requests are being fetched by them, only those they dont fill in time are fetched here
+      leased = _client().lease_multi(missing)
+      for k,value in _client().wait_multi([k for k in missing if k not in leased]).items():
+        results[k] = _MISSING if value == TOMBSTONE else value
+      missing = [k for k in missing if k not in results]
+    if len(missing) == 0:
+      values.update(results)
+      return results
+    keys_to_get = [db.Key.from_path(models.Setting.kind(),k) for k in missing]
+    return utils.Future(lambda settings: from_datastore(missing,leased,settings),utils.batch_get_async(keys_to_get))
+  missing = [k for k in keys if k not in results]
+  if len(missing) == 0:
+    return utils.Future(lambda: results)
+  return utils.Future(from_memcache,_client().get_multi_async(missing))
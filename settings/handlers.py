@@ -0,0 +1,25 @@
+"""
+Request handlers for the settings module. Map constants.SETTINGS_FLUSH_URL to this script in app.yaml (admin only)
+so the task queue can flush write-behind settings.
+"""
+import logging
+import settings
+import constants
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp.util import run_wsgi_app
+
+class FlushHandler(webapp.RequestHandler):
+  """
+  Task queue worker that writes pending write-behind settings to the datastore
+  """
+  def post(self):
+    count = settings.flush()
+    logging.info("pglib.settings: flushed "+str(count)+" write-behind settings")
+    
+application = webapp.WSGIApplication([(constants.SETTINGS_FLUSH_URL, FlushHandler)])
+
+def main():
+  run_wsgi_app(application)
+  
+if __name__ == '__main__':
+  main()
@@ -1,5 +1,9 @@
 import unittest
 import permissions
+import constants
+import utils
+from utils import lru
+from utils import cache
 from google.appengine.api import memcache
 from google.appengine.ext import db
 import logging
@@ -73,7 +77,285 @@ class PermissionTests(unittest.TestCase):
     self.assert_(permissions.has_permission(o3,p2),"should return true for permission")
     self.assert_(permissions.has_permission(o4,p2),"should return true for permission")
     
+  def test_CachedBinding(self):
+    # test that cached has_permission results are invalidated by bind, unbind and delete
+    class CacheObject(db.Model):
+      name = db.StringProperty(required=True)
+    use_memcache = constants.USE_MEMCACHE
+    constants.USE_MEMCACHE = True
+    try:
+      o1 = CacheObject(name="Mick").put()
+      p1 = permissions.create('cache')
+      self.assert_(permissions.has_permission(o1,p1) == False,"object should not have the permission before binding")
+      permissions.bind(p1,o1)
+      self.assert_(permissions.has_permission(o1,p1),"a cached miss must be invalidated by bind")
+      permissions.unbind(p1,o1)
+      self.assert_(permissions.has_permission(o1,p1) == False,"a cached hit must be invalidated by unbind")
+      permissions.bind(p1,o1)
+      self.assert_(permissions.has_permission(o1,p1),"should return true for permission")
+      permissions.delete(p1)
+      self.assert_(permissions.has_permission(o1,p1) == False,"a cached hit must be invalidated by delete")
+    finally:
+      constants.USE_MEMCACHE = use_memcache
+    
+  def test_BindingDependants(self):
+    # test that values cached as depending on a bound object are dropped by bind and unbind
+    class DependantObject(db.Model):
+      name = db.StringProperty(required=True)
+    use_memcache = constants.USE_MEMCACHE
+    constants.USE_MEMCACHE = True
+    try:
+      o1 = DependantObject(name="Bill").put()
+      p1 = permissions.create('depend')
+      memcache.set('derived_from_binding','value')
+      utils.add_dependants('derived_from_binding',[o1])
+      permissions.bind(p1,o1)
+      self.assert_(memcache.get('derived_from_binding') is None,"binding should drop the values that depend on the obj")
+      memcache.set('derived_from_binding','value')
+      utils.add_dependants('derived_from_binding',[p1])
+      permissions.unbind(p1,o1)
+      self.assert_(memcache.get('derived_from_binding') is None,"unbinding should drop the values that depend on the permission")
+    finally:
+      constants.USE_MEMCACHE = use_memcache
+    
+  def test_UnbindDuringCheck(self):
+    # test that a check which read the binding before an unbind doesnt cache its out of date result
+    class RaceObject(db.Model):
+      name = db.StringProperty(required=True)
+    use_memcache = constants.USE_MEMCACHE
+    batch_get_async = utils.batch_get_async
+    constants.USE_MEMCACHE = True
+    try:
+      o1 = RaceObject(name="Keith").put()
+      p1 = permissions.create('race')
+      permissions.bind(p1,o1)
+      def read_then_unbind(keys):
+        # the check has read the datastore, unbind before it fills the cache
+        utils.batch_get_async = batch_get_async
+        entities = batch_get_async(keys).get_result()
+        permissions.unbind(p1,o1)
+        return utils.Future(lambda: entities)
+      utils.batch_get_async = read_then_unbind
+      self.assert_(permissions.has_permission(o1,p1),"the check read the binding before it was removed")
+      self.assert_(permissions.has_permission(o1,p1) == False,"the out of date result must not be cached")
+    finally:
+      constants.USE_MEMCACHE = use_memcache
+      utils.batch_get_async = batch_get_async
+    
+  def test_BatchBinding(self):
+    # test that the batch checks agree with has_permission
+    class BatchObject(db.Model):
+      name = db.StringProperty(required=True)
+    o1 = BatchObject(name="Keith").put()
+    o2 = BatchObject(name="Ronnie").put()
+    p1 = permissions.create('read')
+    p2 = permissions.create('write')
+    permissions.bind(p1,o1,o2)
+    permissions.bind(p2,o2)
+    r = permissions.has_permissions(o1,[p1,p2])
+    self.assert_(r == {p1.key():True,p2.key():False},"has_permissions should return a result for each permission")
+    r = permissions.has_permission_many([o1,o2],p2)
+    self.assert_(r == {o1:False,o2:True},"has_permission_many should return a result for each object")
+    
+  def test_DuplicateBinding(self):
+    # test that binding the same permission twice does not create a second binding
+    class DuplicateObject(db.Model):
+      name = db.StringProperty(required=True)
+    o1 = DuplicateObject(name="Charlie").put()
+    p1 = permissions.create('read')
+    k1 = permissions.bind(p1,o1)
+    k2 = permissions.bind(p1,o1)
+    self.assert_(k1 == k2,"binding twice should return the same binding key")
+    self.assert_(permissions.unbind(p1,o1) == 1,"there should only be one binding to remove")
+    
+  def test_MigrateBindings(self):
+    # test that bindings with generated ids are rewritten under derived key names
+    class LegacyObject(db.Model):
+      name = db.StringProperty(required=True)
+    o1 = LegacyObject(name="Bill").put()
+    p1 = permissions.create('read')
+    permissions.models.PermissionBinding(permission=p1,obj=o1).put()
+    permissions.models.PermissionBinding(permission=p1,obj=o1).put()
+    self.assert_(permissions.migrate_bindings() == 2,"both legacy bindings should be rewritten")
+    self.assert_(permissions.has_permission(o1,p1),"migrated bindings should be found by has_permission")
+    self.assert_(permissions.unbind(p1,o1) == 1,"duplicate legacy bindings should be merged")
+    
   def test_GroupBinding(self):
     # test that when groups are bound they bind all their members
-    pass
-    
\ No newline at end of file
+    class GroupObject(db.Model):
+      name = db.StringProperty(required=True)
+    o1 = GroupObject(name="Roger").put()
+    o2 = GroupObject(name="Pete").put()
+    g1 = permissions.create_group('band')
+    g2 = permissions.create_group('label')
+    p1 = permissions.create('read')
+    p2 = permissions.create('write')
+    permissions.add_member(g1,o1,o2)
+    permissions.add_member(g2,g1)
+    self.assert_(permissions.get_members(g1) == [o1,o2] or permissions.get_members(g1) == [o2,o1],"get_members should return the direct members")
+    self.assert_(permissions.get_groups(g1) == [g2.key()],"get_groups should return the direct groups")
+    permissions.bind(p1,g2)
+    permissions.bind(p2,g1)
+    self.assert_(permissions.has_permission(o1,p1),"members should inherit permissions from nested groups")
+    self.assert_(permissions.has_permission(g1,p1),"groups should inherit permissions from their groups")
+    self.assert_(permissions.has_permission(o2,p2),"members should inherit permissions from their groups")
+    self.assert_(permissions.has_permissions(o1,[p1,p2]) == {p1.key():True,p2.key():True},"batch checks should include inherited permissions")
+    permissions.remove_member(g2,g1)
+    self.assert_(permissions.has_permission(o1,p1) == False,"leaving a group should remove its permissions")
+    self.assert_(permissions.has_permission(o1,p2),"permissions of other groups should be kept")
+    permissions.unbind(p2,g1)
+    self.assert_(permissions.has_permission(o1,p2) == False,"unbinding a group should remove the permission from its members")
+    permissions.bind(p2,g1)
+    permissions.delete_group(g1)
+    self.assert_(permissions.has_permission(o1,p2) == False,"deleting a group should remove its permissions from its members")
+    self.assert_(permissions.get_group('band') is None,"deleted groups should not be returned")
+    
+  def test_SharedGroupBinding(self):
+    # test that unbinding one group keeps the permission for members that still get it through another group
+    class SharedObject(db.Model):
+      name = db.StringProperty(required=True)
+    o1 = SharedObject(name="Jimmy").put()
+    o2 = SharedObject(name="Robert").put()
+    g1 = permissions.create_group('guitars')
+    g2 = permissions.create_group('vocals')
+    p1 = permissions.create('play')
+    permissions.add_member(g1,o1,o2)
+    permissions.add_member(g2,o2)
+    permissions.bind(p1,g1,g2)
+    self.assert_(permissions.has_permission_many([o1,o2],p1) == {o1:True,o2:True},"members of both groups should inherit the permission")
+    permissions.unbind(p1,g1)
+    self.assert_(permissions.has_permission(o1,p1) == False,"unbinding a group should remove the permission from its members")
+    self.assert_(permissions.has_permission(o2,p1),"members should keep permissions they still get from another group")
+    permissions.unbind(p1)
+    self.assert_(permissions.has_permission(o2,p1) == False,"unbinding everywhere should remove the permission from every member")
+    
+  def test_PermissionBitmaps(self):
+    # test that the permission bitmaps answer the same questions as the bindings
+    class BitmapObject(db.Model):
+      name = db.StringProperty(required=True)
+    use_bitmaps = constants.USE_PERMISSION_BITMAPS
+    constants.USE_PERMISSION_BITMAPS = True
+    try:
+      o1 = BitmapObject(name="Syd").put()
+      o2 = BitmapObject(name="Nick").put()
+      g1 = permissions.create_group('floyd')
+      p1 = permissions.create('read')
+      p2 = permissions.create('write')
+      permissions.bind(p1,o1)
+      permissions.add_member(g1,o2)
+      permissions.bind(p2,g1)
+      self.assert_(permissions.get_bitmap(o1) != '',"bound objects should have a bitmap")
+      self.assert_(permissions.has_permission(o1,p1),"should return true for permission")
+      self.assert_(permissions.has_permission(o1,p2) == False,"object 1 should not have this permission")
+      self.assert_(permissions.has_permissions(o2,[p1,p2]) == {p1.key():False,p2.key():True},"bitmaps should include inherited permissions")
+      p3 = permissions.create('execute')
+      self.assert_(permissions.has_permission(o1,p3) == False,"permissions that were never bound shouldnt be held")
+      self.assert_(db.get(p3.key()).bit is None,"checks shouldnt allocate bit ids")
+      permissions.unbind(p1,o1)
+      self.assert_(permissions.has_permission(o1,p1) == False,"unbind should clear the bit")
+      permissions.delete(p2)
+      self.assert_(permissions.get_bitmap(o2) == '',"deleting a permission should clear its inherited bits")
+    finally:
+      constants.USE_PERMISSION_BITMAPS = use_bitmaps
+    
+  def test_WildcardPermissions(self):
+    # test prefix searches, wildcard gets and hierarchical action checks
+    class WildcardObject(db.Model):
+      name = db.StringProperty(required=True)
+    use_memcache = constants.USE_MEMCACHE
+    constants.USE_MEMCACHE = True
+    try:
+      o1 = WildcardObject(name="Brian").put()
+      p1 = permissions.create('doc.edit.body')
+      p2 = permissions.create('doc.edit.title')
+      p3 = permissions.create('doc.view')
+      p4 = permissions.create('doc.edit.*')
+      self.assert_(permissions.get('doc.view') == p3,"should return the doc.view permission")
+      self.assert_(permissions.get('Doc.View') == p3,"actions should be matched ignoring case")
+      permissions.functions._update_trie(lambda root: permissions.functions._trie_remove(root,'doc.view',None))
+      self.assert_(permissions.get('doc.view') == p3,"permissions missing from the trie should be found by key name")
+      self.assert_(permissions.get('doc.delete') == None,"trying to get permissions that dont exist should return None")
+      found = permissions.find('doc.edit')
+      self.assert_(len(found) == 3 and p1 in found and p2 in found and p4 in found,"find should return every permission under the prefix")
+      self.assert_(len(permissions.get('doc.*')) == 4,"wildcard gets should return every permission under the prefix")
+      self.assert_(permissions.find('doc.ed') == [],"prefixes should match whole segments")
+      self.assert_(permissions.has_action(o1,'doc.edit.body') == False,"object should not have the permission before binding")
+      permissions.bind(p4,o1)
+      self.assert_(permissions.has_action(o1,'doc.edit.body'),"doc.edit.* should grant doc.edit.body")
+      self.assert_(permissions.has_action(o1,'doc.view') == False,"doc.edit.* should not grant doc.view")
+      permissions.delete(p3)
+      self.assert_(permissions.get('doc.view') == None,"deleted permissions should not be returned")
+    finally:
+      constants.USE_MEMCACHE = use_memcache
+    
+  def test_WildcardQueries(self):
+    # test prefix searches and hierarchical action checks without the memcache trie
+    class QueryObject(db.Model):
+      name = db.StringProperty(required=True)
+    o1 = QueryObject(name="Roger").put()
+    p1 = permissions.create('page.edit.body')
+    p2 = permissions.create('Page.Edit.*')
+    p3 = permissions.create('page.editor')
+    p4 = permissions.create('page.edit',obj=p1)
+    found = permissions.find('page.edit')
+    self.assert_(len(found) == 3 and p1 in found and p2 in found and p4 in found,"find should return every permission under the prefix")
+    self.assert_(permissions.find('page.edit',obj=p1) == [p4],"find should only return the permissions for the obj")
+    self.assert_(len(permissions.get('page.*')) == 4,"wildcard gets should return every permission under the prefix")
+    self.assert_(permissions.has_action(o1,'page.edit.body') == False,"object should not have the permission before binding")
+    permissions.bind(p2,o1)
+    self.assert_(permissions.has_action(o1,'page.edit.body'),"page.edit.* should grant page.edit.body")
+    self.assert_(permissions.has_action(o1,'page.editor') == False,"page.edit.* should not grant page.editor")
+    
+  def test_ChunkedTrie(self):
+    # test that a trie too big for one memcache item is rebuilt rather than updated
+    use_memcache = constants.USE_MEMCACHE
+    chunk_size = cache.MEMCACHE_CHUNK_SIZE
+    constants.USE_MEMCACHE = True
+    cache.MEMCACHE_CHUNK_SIZE = 64
+    try:
+      created = [permissions.create('big.action'+str(i)) for i in range(10)]
+      self.assert_([permissions.get('big.action'+str(i)) for i in range(10)] == created,"every permission should be found in the chunked trie")
+      p1 = permissions.create('big.last')
+      self.assert_(permissions.get('big.last') == p1,"permissions created after the trie was chunked should be found")
+      permissions.delete(p1)
+      self.assert_(permissions.get('big.last') == None,"deleted permissions should not be returned")
+    finally:
+      constants.USE_MEMCACHE = use_memcache
+      cache.MEMCACHE_CHUNK_SIZE = chunk_size
+    
+  def test_AsyncPermissions(self):
+    # test that the async variants agree with the blocking versions
+    class AsyncObject(db.Model):
+      name = db.StringProperty(required=True)
+    o1 = AsyncObject(name="Freddie").put()
+    o2 = AsyncObject(name="Brian").put()
+    p1 = permissions.create('read')
+    keys = permissions.bind_async(p1,o1).get_result()
+    self.assert_(len(keys) == 1,"bind_async should return a key for each binding")
+    r = utils.wait_all([permissions.has_permission_async(o1,p1),permissions.has_permission_async(o2,p1),permissions.get_async('read'),permissions.get_async('bingle')])
+    self.assert_(r == [True,False,p1,None],"async checks and gets should return the same results as the blocking versions")
+    
+  def test_LocalCache(self):
+    # test that checks and gets are answered from instance memory and that binds, unbinds and deletes invalidate them
+    class LocalObject(db.Model):
+      name = db.StringProperty(required=True)
+    constants.USE_LOCAL_CACHE = True
+    lru.shared.clear()
+    try:
+      o1 = LocalObject(name="Roger").put()
+      p1 = permissions.create('local.read')
+      self.assert_(permissions.has_permission(o1,p1) == False,"object should not have the permission before binding")
+      self.assert_(permissions.get('local.read') == p1,"should return the local.read permission")
+      hits = lru.shared.stats()['hits']
+      self.assert_(permissions.has_permission(o1,p1) == False and permissions.get('local.read') == p1,"cached results should match")
+      self.assert_(lru.shared.stats()['hits'] == hits+2,"repeat lookups should be answered from instance memory")
+      permissions.bind(p1,o1)
+      self.assert_(permissions.has_permission(o1,p1),"bind should invalidate the cached result")
+      permissions.unbind(p1,o1)
+      self.assert_(permissions.has_permission(o1,p1) == False,"unbind should invalidate the cached result")
+      permissions.delete(p1)
+      self.assert_(permissions.get('local.read') == None,"deleted permissions should not be returned")
+    finally:
+      constants.USE_LOCAL_CACHE = False
+      lru.shared.clear()
+
@@ -1,8 +1,16 @@
 import unittest
 import settings
+import constants
+import utils
+from utils import lru
+from utils import cache
+from utils import rpc
+import os
 import random
 import types
+import StringIO
 from google.appengine.api import memcache
+from google.appengine.ext import db
 
 
 # supported types
@@ -26,6 +34,7 @@ class GlobalSettingTests (unittest.TestCase):
 
   def setUp(self):
     memcache.flush_all()
+    settings.reset()
 
   def test_createBasicSetting(self):
     # test the creation of a basic settings object
@@ -92,4 +101,260 @@ class GlobalSettingTests (unittest.TestCase):
     # test that using a string index actually returns the correct object
     s = settings.set('an_index',is_global=IS_GLOBAL,value="sandwich")
     t = settings.get('an_index',user_first=not IS_GLOBAL)
-    self.assert_(t['value'] == "sandwich","Returned value must be the same as the stored value")
\ No newline at end of file
+    self.assert_(t['value'] == "sandwich","Returned value must be the same as the stored value")
+    
+  def test_RequestCache(self):
+    # test that repeat reads during a request are served from the request cache until it is reset
+    settings.set('cached_index',is_global=True,value="cheese")
+    self.assert_(settings.get('cached_index')['value'] == "cheese","Returned value must be the same as the stored value")
+    memcache.flush_all()
+    settings.models.Setting.get_by_key_name(settings.functions.GLOBAL_KEY('cached_index')).delete()
+    self.assert_(settings.get('cached_index')['value'] == "cheese","Repeat reads should come from the request cache")
+    settings.reset()
+    self.assert_(settings.get('cached_index',default={'value':'gone'})['value'] == "gone","After a reset the setting should be looked up again")
+    settings.set('cached_index',is_global=True,value="crackers")
+    self.assert_(settings.get('cached_index')['value'] == "crackers","settings.set should update the request cache")
+    
+  def test_RequestBoundary(self):
+    # test that the request cache is emptied when the thread starts serving another request
+    request_id = os.environ.get('REQUEST_LOG_ID')
+    try:
+      os.environ['REQUEST_LOG_ID'] = 'first'
+      settings.set('boundary_index',is_global=True,value="cheese")
+      memcache.flush_all()
+      settings.models.Setting.get_by_key_name(settings.functions.GLOBAL_KEY('boundary_index')).delete()
+      self.assert_(settings.get('boundary_index')['value'] == "cheese","Repeat reads should come from the request cache")
+      os.environ['REQUEST_LOG_ID'] = 'second'
+      self.assert_(settings.get('boundary_index',default={'value':'gone'})['value'] == "gone","A new request should look the setting up again")
+    finally:
+      if request_id is None:
+        del os.environ['REQUEST_LOG_ID']
+      else:
+        os.environ['REQUEST_LOG_ID'] = request_id
+    
+  def test_GetMulti(self):
+    # test that get_multi applies the same precedence as get for every index
+    settings.set('multi_one',is_global=True,value='global one')
+    settings.set('multi_one',value='user one')
+    settings.set('multi_two',is_global=True,value='global two')
+    settings.reset()
+    v = settings.get_multi(['multi_one','multi_two','multi_three'],default={'value':'none'})
+    self.assert_(v['multi_one']['value'] == 'global one',"get_multi should return the global value unless user_first is set")
+    self.assert_(v['multi_two']['value'] == 'global two',"get_multi should return the global value unless user_first is set")
+    self.assert_(v['multi_three']['value'] == 'none',"The default value should be returned for a key that doesnt exist")
+    v = settings.get_multi(['multi_one','multi_two'],user_first=True)
+    self.assert_(v['multi_one']['value'] == 'user one',"User setting should be returned in favour of the global setting when user_first is True")
+    self.assert_(v['multi_two']['value'] == 'global two',"The global value should be returned when there is no user value")
+    
+  def test_MissingSettingCache(self):
+    # test that missing settings are remembered in memcache until they are set
+    v = settings.get('absent_index',default={'value':'absent'})
+    self.assert_(v['value'] == 'absent',"The default value should be returned for a key that doesnt exist")
+    key = settings.functions.GLOBAL_KEY('absent_index')
+    self.assert_(settings.functions._client().get(key) == settings.functions.TOMBSTONE,"A missing setting should leave a tombstone in memcache")
+    settings.set('absent_index',is_global=True,value='present')
+    settings.reset()
+    self.assert_(settings.get('absent_index')['value'] == 'present',"settings.set should replace the tombstone")
+    
+  def test_LoadSettings(self):
+    # test that settings are loaded from yaml and that reloading only writes changes
+    data = "load_one: 1\nload_two: {value: two, other: 2}\n---\nload_three: [1, 2, 3]\n"
+    counts = settings.load(StringIO.StringIO(data))
+    self.assert_(counts == {'created':3,'updated':0,'unchanged':0},"Every setting should be created: "+str(counts))
+    self.assert_(settings.get('load_two')['other'] == 2,"Loaded settings should keep all of their properties")
+    self.assert_(settings.get('load_three')['value'] == [1,2,3],"Plain values should be stored as value")
+    counts = settings.load(StringIO.StringIO(data.replace("load_one: 1","load_one: 5")))
+    self.assert_(counts == {'created':0,'updated':1,'unchanged':2},"Only the changed setting should be written: "+str(counts))
+    settings.reset()
+    self.assert_(settings.models.Setting.get_by_key_name(settings.functions.GLOBAL_KEY('load_one')).value == 5,"The changed setting should be stored")
+    
+  def test_LoadInvalidSettings(self):
+    # test that documents that arent mappings and reserved property names are rejected
+    self.assertRaises(ValueError,settings.load,StringIO.StringIO("- load_list\n"))
+    self.assertRaises(ValueError,settings.load,StringIO.StringIO("just a string\n"))
+    self.assertRaises(ValueError,settings.load,StringIO.StringIO("load_reserved: {index: 1}\n"))
+    self.assertRaises(ValueError,settings.load,StringIO.StringIO("load_reserved: {owner: someone}\n"))
+    self.assert_(settings.models.Setting.get_by_key_name(settings.functions.GLOBAL_KEY('load_reserved')) is None,"Rejected settings shouldnt be stored")
+    
+  def test_SettingDependants(self):
+    # test that values cached against a setting are invalidated when it is set
+    s = settings.set('dependant_index',is_global=True,value=1)
+    memcache.set('derived_from_setting','derived value')
+    utils.add_dependants('derived_from_setting',[s])
+    settings.set('dependant_index',is_global=True,value=2)
+    self.assert_(memcache.get('derived_from_setting') is None,"settings.set should invalidate dependant values")
+    
+  def test_AsyncSettings(self):
+    # test that async gets and sets return the same results as the blocking versions
+    s = settings.set_async('async_one',is_global=True,value='one').get_result()
+    self.assert_(s.value == 'one',"set_async should return the stored setting")
+    settings.set('async_two',is_global=True,value='two')
+    settings.reset()
+    one, two, three = utils.wait_all([settings.get_async('async_one'),settings.get_async('async_two'),settings.get_async('async_three',default={'value':'three'})])
+    self.assert_(one['value'] == 'one' and two['value'] == 'two',"get_async should return the stored values")
+    self.assert_(three['value'] == 'three',"The default value should be returned for a key that doesnt exist")
+    
+  def test_WriteBehind(self):
+    # test that write-behind values are visible straight away and written by flush
+    settings.set('behind_index',is_global=True,value='first',other='kept')
+    settings.set_write_behind('behind_index',is_global=True,value='second')
+    settings.set_write_behind('behind_index',is_global=True,value='third')
+    settings.reset()
+    self.assert_(settings.get('behind_index')['value'] == 'third',"write-behind values should be read back straight away")
+    key = settings.functions.GLOBAL_KEY('behind_index')
+    self.assert_(settings.models.Setting.get_by_key_name(key).value == 'first',"write-behind values should not be written until flushed")
+    self.assert_(settings.flush() == 1,"repeated writes to one setting should be coalesced")
+    s = settings.models.Setting.get_by_key_name(key)
+    self.assert_(s.value == 'third' and s.other == 'kept',"flush should write the latest value")
+    self.assert_(settings.flush() == 0,"nothing should be left to flush")
+    
+  def test_UnstoredWriteBehind(self):
+    # test that a write-behind value memcache wont store is written to the datastore straight away
+    client = settings.functions._client()
+    client.set_multi = lambda mapping,time=0: mapping.keys()
+    try:
+      settings.set_write_behind('unstored_index',is_global=True,value='behind')
+    finally:
+      del client.set_multi
+    key = settings.functions.GLOBAL_KEY('unstored_index')
+    self.assert_(settings.models.Setting.get_by_key_name(key).value == 'behind',"the value should be written straight away")
+    self.assert_(settings.flush() == 0,"nothing should be left to flush")
+    
+  def test_FailedFlush(self):
+    # test that a flush which cant store its batch leaves the settings to be written by the next flush
+    settings.set_write_behind('failed_index',is_global=True,value='behind')
+    batch_put = utils.batch_put
+    def failing_put(models):
+      raise db.Timeout()
+    utils.batch_put = failing_put
+    try:
+      self.assertRaises(db.Timeout,settings.flush)
+    finally:
+      utils.batch_put = batch_put
+    self.assert_(settings.flush() == 1,"the setting should still be waiting to be flushed")
+    key = settings.functions.GLOBAL_KEY('failed_index')
+    self.assert_(settings.models.Setting.get_by_key_name(key).value == 'behind',"the next flush should write the value")
+    
+  def test_ReplaceAndMerge(self):
+    # test that replace overwrites the whole setting and merge keeps the other properties
+    settings.set('mode_index',is_global=True,value=1,other=2)
+    s = settings.set('mode_index',is_global=True,merge=True,value=3)
+    self.assert_(s.value == 3 and s.other == 2,"merge should keep the properties that werent set")
+    s = settings.set('mode_index',is_global=True,replace=True,value=4)
+    self.assert_(s.value == 4 and not hasattr(s,'other'),"replace should drop the properties that werent set")
+    settings.reset()
+    self.assert_(settings.get('mode_index') == {'value':4},"the cached value should match the replaced setting")
+    
+  def test_SettingsSnapshot(self):
+    # test that global settings are answered from the instance snapshot and reloaded when a global setting is set
+    constants.USE_SETTINGS_SNAPSHOT = True
+    try:
+      settings.set('snapshot_index',is_global=True,value=1)
+      settings.reset()
+      self.assert_(settings.get('snapshot_index')['value'] == 1,"the snapshot should hold the stored value")
+      memcache.flush_all()
+      settings.reset()
+      self.assert_(settings.get('snapshot_index')['value'] == 1,"global settings should be read from the snapshot")
+      self.assert_(memcache.get(settings.functions.GLOBAL_KEY('snapshot_index')) is None,"snapshot reads shouldnt touch memcache")
+      settings.set('snapshot_index',is_global=True,value=2)
+      settings.reset()
+      self.assert_(settings.get('snapshot_index')['value'] == 2,"setting a global setting should reload the snapshot")
+      self.assert_(settings.get('snapshot_absent',default={'value':'absent'})['value'] == 'absent',"settings missing from the snapshot should get the default")
+    finally:
+      constants.USE_SETTINGS_SNAPSHOT = False
+    
+  def test_SnapshotWriteBehind(self):
+    # test that global write-behind values are seen by snapshot readers
+    constants.USE_SETTINGS_SNAPSHOT = True
+    try:
+      settings.set('snapshot_behind_index',is_global=True,value=1)
+      settings.reset()
+      self.assert_(settings.get('snapshot_behind_index')['value'] == 1,"the snapshot should hold the stored value")
+      settings.set_write_behind('snapshot_behind_index',is_global=True,value=2)
+      settings.reset()
+      self.assert_(settings.get('snapshot_behind_index')['value'] == 2,"the snapshot should see the write-behind value")
+      memcache.flush_all()
+      settings.reset()
+      self.assert_(settings.get('snapshot_behind_index')['value'] == 2,"the write-behind value should be in the datastore")
+    finally:
+      constants.USE_SETTINGS_SNAPSHOT = False
+    
+  def test_SnapshotRecheck(self):
+    # test that a snapshot reload reads back settings written recently that its query doesnt see yet
+    constants.USE_SETTINGS_SNAPSHOT = True
+    iter_all = utils.iter_all
+    try:
+      settings.set('recheck_index',is_global=True,value=1)
+      settings.reset()
+      self.assert_(settings.get('recheck_index')['value'] == 1,"the snapshot should hold the stored value")
+      utils.iter_all = lambda query: []
+      settings.set('recheck_index',is_global=True,value=2)
+      settings.set('recheck_new_index',is_global=True,value=3)
+      settings.reset()
+      self.assert_(settings.get('recheck_index')['value'] == 2,"a write the query doesnt see should be read back by key")
+      self.assert_(settings.get('recheck_new_index')['value'] == 3,"a new setting the query doesnt see should be read back by key")
+    finally:
+      constants.USE_SETTINGS_SNAPSHOT = False
+      utils.iter_all = iter_all
+    
+  def test_LocalCache(self):
+    # test that settings are answered from instance memory after memcache is emptied and that set updates them
+    constants.USE_LOCAL_CACHE = True
+    lru.shared.clear()
+    try:
+      settings.set('local_index',is_global=True,value=1)
+      settings.reset()
+      self.assert_(settings.get('local_index')['value'] == 1,"should return the stored value")
+      memcache.flush_all()
+      settings.reset()
+      self.assert_(settings.get('local_index')['value'] == 1,"should be answered from instance memory")
+      self.assert_(memcache.get(settings.functions.GLOBAL_KEY('local_index')) is None,"local hits shouldnt touch memcache")
+      settings.set('local_index',is_global=True,value=2)
+      settings.reset()
+      self.assert_(settings.get('local_index')['value'] == 2,"settings.set should update instance memory")
+    finally:
+      constants.USE_LOCAL_CACHE = False
+      lru.shared.clear()
+    
+  def test_CacheLeases(self):
+    # test that a cold key is filled by the request holding its lease and that other requests get the stale copy
+    constants.USE_CACHE_LEASES = True
+    try:
+      settings.set('leased_index',is_global=True,value=1)
+      key = settings.functions.GLOBAL_KEY('leased_index')
+      memcache.flush_all()
+      settings.reset()
+      self.assert_(settings.get('leased_index')['value'] == 1,"the request holding the lease should fetch the setting")
+      self.assert_(memcache.get(cache.LEASE_KEY(key)) is None,"filling the key should release the lease")
+      # another request is filling the key
+      memcache.delete(key)
+      self.assert_(settings.functions._client().lease_multi([key]) == [key],"the lease should be free")
+      settings.reset()
+      self.assert_(settings.get('leased_index')['value'] == 1,"requests without the lease should get the stale copy")
+      settings.set('leased_index',is_global=True,value=2)
+      memcache.delete(key)
+      settings.reset()
+      self.assert_(settings.get('leased_index')['value'] == 2,"settings.set should refresh the stale copy")
+    finally:
+      constants.USE_CACHE_LEASES = False
+    
+  def test_RPCAccounting(self):
+    # test that the rpcs made by each settings call are counted against it
+    constants.RPC_ACCOUNTING = True
+    rpc.reset()
+    rpc.clear()
+    try:
+      settings.set('rpc_index',is_global=True,value=1)
+      settings.reset()
+      settings.get('rpc_index')
+      summary = rpc.summary()
+      self.assert_(summary['settings.set']['calls'] == 1 and summary['settings.set']['rpcs'] > 0,"the rpcs made by set should be counted")
+      self.assert_(summary['settings.get']['rpcs'] == 1 and summary['settings.get']['services'] == {'memcache.Get':1},"a cached get should cost one memcache get: "+str(summary['settings.get']))
+      self.assert_(sum(summary['settings.get']['latency']) == 1 and summary['settings.get']['bytes'] > 0,"the rpc latency and size should be recorded")
+      self.assert_(rpc.histogram()['settings.get']['rpcs'] == 1,"the process totals should include the request")
+    finally:
+      constants.RPC_ACCOUNTING = False
+    settings.reset()
+    settings.get('rpc_index')
+    self.assert_(rpc.summary()['settings.get']['calls'] == 1,"calls shouldnt be counted when accounting is off")
+
@@ -0,0 +1,157 @@
+import unittest
+import utils
+import os
+import sys
+from utils import cache
+from utils import codec
+from utils import lru
+import time
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+class UtilObject(db.Model):
+  name = db.StringProperty(required=True)
+
+class UtilTests(unittest.TestCase):
+  def setUp(self):
+    memcache.flush_all()
+    
+  def test_Chunks(self):
+    # test that lists are split into size limited chunks without losing items
+    self.assert_(utils.chunks(range(7),3) == [[0,1,2],[3,4,5],[6]],"the last chunk should hold the remainder")
+    self.assert_(utils.chunks([],3) == [],"an empty list has no chunks")
+    
+  def test_BatchWrites(self):
+    # test that batch_put, batch_get and batch_delete handle more entities than fit in one call
+    objs = [UtilObject(name=str(i)) for i in range(utils.MAX_BATCH_SIZE+10)]
+    keys = utils.batch_put(objs)
+    self.assert_(len(keys) == len(objs),"a key should be returned for every entity")
+    self.assert_([o.name for o in utils.batch_get(keys)] == [o.name for o in objs],"entities should come back in key order")
+    utils.batch_delete(keys)
+    self.assert_(utils.batch_get(keys) == [None]*len(keys),"all entities should be deleted")
+    
+  def test_IterBatches(self):
+    # test that walking a query with cursors returns every result exactly once
+    keys = utils.batch_put([UtilObject(name=str(i)) for i in range(7)])
+    batches = list(utils.iter_batches(UtilObject.all(keys_only=True),3))
+    self.assert_([len(b) for b in batches] == [3,3,1],"results should be split into batch_size pages")
+    self.assert_(sorted(utils.iter_all(UtilObject.all(keys_only=True),3)) == sorted(keys),"iter_all should yield every result")
+    self.assert_(len(utils.fetch_all(UtilObject.all())) == 7,"fetch_all should return every result")
+    
+  def test_Dependants(self):
+    # test that cached values are deleted when an object they depend on changes
+    o1 = UtilObject(name="one").put()
+    o2 = UtilObject(name="two").put()
+    memcache.set('derived_one','value one')
+    memcache.set('derived_both','value both')
+    self.assert_(utils.add_dependants('derived_one',[o1]),"dependencies should be recorded")
+    self.assert_(utils.add_dependants('derived_both',[o1,o2]),"dependencies should be recorded")
+    stale = utils.remove_dependants([o2])
+    self.assert_(stale == set(['derived_both']),"only values depending on o2 should be removed")
+    self.assert_(memcache.get('derived_both') is None,"dependant values should be deleted")
+    self.assert_(memcache.get('derived_one') == 'value one',"unrelated values should be kept")
+    utils.remove_dependants([o1])
+    self.assert_(memcache.get('derived_one') is None,"dependant values should be deleted")
+    self.assert_(utils.remove_dependants([o1]) == set(),"dependency sets should be emptied once invalidated")
+    
+  def test_Bitsets(self):
+    # test setting, clearing and combining bits
+    bits = utils.to_bitset([0,9])
+    self.assert_(bits == '\x01\x02',"bits should be packed eight to a byte")
+    self.assert_(utils.test_bit(bits,9) and not utils.test_bit(bits,8) and not utils.test_bit(bits,100),"only set bits should test true")
+    self.assert_(utils.set_bit(bits,9,False) == '\x01',"trailing empty bytes should be dropped")
+    self.assert_(utils.union_bits('\x01','\x00\x04') == '\x01\x04',"union should keep the bits of both bitsets")
+    
+  def test_ChunkedCache(self):
+    # test that values too big for one memcache item are split into chunks and read back whole
+    client = cache.Client()
+    big = [os.urandom(1000) for i in range(2000)]
+    self.assert_(client.set_multi({'big_value':big,'small_value':'small'}) == [],"both values should be stored")
+    self.assert_(client.get_multi(['big_value','small_value','no_value']) == {'big_value':big,'small_value':'small'},"chunked values should be read back whole")
+    marker, id, count, checksum, compressed = codec.decode(memcache.get('big_value'))
+    self.assert_(marker == cache.MANIFEST and count > 1,"the big value should be stored as a manifest of chunks")
+    memcache.delete(cache.CHUNK_KEY('big_value',id,count-1))
+    self.assert_(client.get('big_value') is None,"a value with a missing chunk should be a miss")
+    self.assert_(client.set('repeated',['x'*1000+str(i) for i in range(2000)]) and len(client.get('repeated')) == 2000,"compressible values should be stored too")
+    
+  def test_Codecs(self):
+    # test that every codec reads back what it wrote and that unsupported values fall back to pickle
+    value = {'value':[1,2.5,'three',u'four',None,True],'other':{'nested':(1,2)}}
+    for name in ['pickle','marshal']:
+      self.assert_(codec.decode(codec.encode(value,name)) == value,"the "+name+" codec should read back what it wrote")
+    self.assert_(codec.decode(codec.encode({'a':[1,'b']},'json')) == {'a':[1,'b']},"the json codec should read back what it wrote")
+    key = db.Key.from_path('UtilObject',1)
+    data = codec.encode([key],'marshal')
+    self.assert_(data[0] == '\x01' and codec.decode(data) == [key],"values marshal cant handle should be pickled")
+    value = {'value':db.Text(u'hello'),'data':db.Blob('\x00\x01')}
+    for name in ['marshal','json']:
+      decoded = codec.decode(codec.encode(value,name))
+      self.assert_(decoded == value and type(decoded['value']) is db.Text and type(decoded['data']) is db.Blob,"the "+name+" codec should pickle subclasses of builtin types")
+    self.assertRaises(ValueError,codec.decode,'\xffnot encoded')
+    
+  def test_LRUCache(self):
+    # test that the least recently used entry is evicted, entries expire and the counters are kept
+    local = lru.LRUCache(3,0)
+    local.set_multi({'a':1,'b':2})
+    local.set('c',3)
+    self.assert_(local.get('a') == 1,"cached values should be returned")
+    local.set('d',4)
+    self.assert_(local.get_multi(['a','b','c','d']) == {'a':1,'c':3,'d':4},"the least recently used entry should be evicted")
+    local.set('e',5,ttl=0.01)
+    time.sleep(0.02)
+    self.assert_(local.get('e','expired') == 'expired',"expired entries should be misses")
+    local.delete('a')
+    self.assert_(local.get('a') is None,"deleted entries should be misses")
+    self.assert_(local.stats() == {'hits':4,'misses':3,'evictions':2,'entries':2},"counters should be kept: "+str(local.stats()))
+    
+  def test_LRUCacheBytes(self):
+    # test that the cache is bounded by the encoded size of its values and skips values that are too big
+    size = len(codec.encode('x'*100))
+    local = lru.LRUCache(100,0,max_bytes=size*2,max_value=size)
+    local.set_multi({'a':'x'*100,'b':'y'*100})
+    self.assert_(local.bytes == size*2,"the size of every entry should be counted")
+    local.set('c','z'*100)
+    self.assert_(local.get('a') is None and local.get('c') == 'z'*100,"the least recently used entry should be evicted to make room")
+    local.set('big','x'*1000)
+    self.assert_(local.get('big') is None and local.bytes == size*2,"values bigger than max_value shouldnt be cached")
+    
+  def test_Leases(self):
+    # test that only one request gets the lease on a missing key and the others get its value or the stale copy
+    client = cache.Client()
+    self.assert_(client.lease_multi(['leased']) == ['leased'],"the first request should get the lease")
+    self.assert_(client.lease_multi(['leased']) == [],"other requests shouldnt get the lease")
+    self.assert_(client.wait_multi(['leased']) == {},"nothing should be returned before the key is filled")
+    client.fill_multi({'leased':'value'},['leased'])
+    self.assert_(client.wait_multi(['leased'],stale=False) == {'leased':'value'},"the filled value should be returned")
+    self.assert_(client.lease_multi(['leased']) == ['leased'],"filling a key should release its lease")
+    client.delete('leased')
+    self.assert_(client.wait_multi(['leased']) == {'leased':'value'},"the stale copy should be returned while the key is filled")
+    client.set('kept','newer')
+    client.fill_multi({'kept':'older'},['kept'])
+    self.assert_(client.get('kept') == 'newer',"filling a key shouldnt overwrite a value set while it was fetched")
+    self.assert_(client.lease_multi(['other']) == ['other'],"the first request should get the lease")
+    client.fill_multi({'other':'value'},[])
+    self.assert_(client.lease_multi(['other']) == [],"filling a key shouldnt release a lease the request doesnt hold")
+    
+  def test_LazyPackages(self):
+    # test that importing a package doesnt import its submodules until a public name is used
+    # settings.models stays loaded so the Setting kind isnt registered twice
+    saved = dict([(k,v) for k,v in sys.modules.items() if k == 'settings' or k.startswith('settings.')])
+    try:
+      for name in ['settings','settings.functions','settings.exceptions']:
+        sys.modules.pop(name,None)
+      import settings
+      self.assert_('settings.functions' not in sys.modules,"importing the package shouldnt import its functions")
+      self.assert_(callable(settings.get),"public names should be available from the package")
+      self.assert_('settings.functions' in sys.modules,"using a public name should import its submodule")
+      self.assert_(settings.get is sys.modules['settings.functions'].get,"the package should return the submodule's function")
+      self.assert_('get' in dir(settings) and 'load' in dir(settings),"dir should list the public names")
+      namespace = {}
+      exec "from settings import *" in namespace
+      self.assert_(namespace.get('functions') is sys.modules['settings.functions'],"import * should expose the names in __all__")
+      self.assertRaises(AttributeError,getattr,settings,'missing')
+    finally:
+      for name in [k for k in sys.modules if k == 'settings' or k.startswith('settings.')]:
+        del sys.modules[name]
+      sys.modules.update(saved)
+
@@ -1,7 +1,8 @@
 # Basic util functions that I might need.
 
+from google.appengine.api import memcache
 from google.appengine.ext import db
-from constants import MAX_FETCH_LIMIT
+from constants import MAX_FETCH_LIMIT, MAX_BATCH_SIZE, MEMCACHE_CAS_RETRIES
 
 # Credit to Trent Mick on http://code.activestate.com/recipes/115417-subset-of-a-dictionary/
 def extract(d, keys):
@@ -26,38 +27,181 @@ def update_expando(model,dictionary):
   
 def fetch_all(query):
   # fetch all of the results for the given query
-  offset = 0
+  return list(iter_all(query))
+  
+def iter_all(query,batch_size=MAX_FETCH_LIMIT):
+  # generator over all of the results for the given query, fetched batch_size at a time
+  for batch in iter_batches(query,batch_size):
+    for result in batch:
+      yield result
+      
+def iter_batches(query,batch_size=MAX_FETCH_LIMIT):
+  # generator of lists of up to batch_size results for the given query
+  # pages are walked with cursors rather than offsets so each page costs the same, use a keys_only query to get just the keys
+  results = query.fetch(batch_size)
+  while len(results) > 0:
+    yield results
+    if len(results) < batch_size:
+      break
+    query.with_cursor(query.cursor())
+    results = query.fetch(batch_size)
+
+def chunks(seq,size=MAX_BATCH_SIZE):
+  # split a list into lists of at most size items
+  return [seq[i:i+size] for i in range(0,len(seq),size)]
+  
+def batch_get(keys):
+  # db.get a list of keys of any length, size limited batches at a time
   results = []
-  query_results = query.fetch(MAX_FETCH_LIMIT,offset)
-  while len(query_results) > 0:
-    results.extend(query_results)
-    offset = offset + MAX_FETCH_LIMIT
-    query_results = query.fetch(MAX_FETCH_LIMIT,offset)
+  for chunk in chunks(keys):
+    results.extend(db.get(chunk))
   return results
+  
+def batch_put(models):
+  # db.put a list of models of any length, size limited batches at a time. Returns the keys
+  keys = []
+  for chunk in chunks(models):
+    keys.extend(db.put(chunk))
+  return keys
+  
+def batch_delete(keys):
+  # db.delete a list of keys or models of any length, size limited batches at a time
+  for chunk in chunks(keys):
+    db.delete(chunk)
 
+def batch_get_async(keys):
+  # start db.get_async calls for a list of keys of any length, returns a Future of the list of results
+  rpcs = [db.get_async(chunk) for chunk in chunks(keys)]
+  return Future(lambda *results: sum([list(r) for r in results],[]),*rpcs)
+  
+def batch_put_async(models):
+  # start db.put_async calls for a list of models of any length, returns a Future of the list of keys
+  rpcs = [db.put_async(chunk) for chunk in chunks(models)]
+  return Future(lambda *results: sum([list(r) for r in results],[]),*rpcs)
+  
+# Async functions.
+class Future(object):
+  """
+  The eventual result of an async call. Holds the rpcs (or other Futures) that have already been started and a callback
+  that turns their results into the value. The callback can return another Future to chain a second round of rpcs.
+  """
+  def __init__(self,callback,*rpcs):
+    self._callback = callback
+    self._rpcs = rpcs
+    self._done = False
+    self._result = None
+    
+  def _step(self):
+    # wait for the current round of rpcs and run the callback, returns True once the final result is known
+    if not self._done:
+      result = self._callback(*[rpc.get_result() for rpc in self._rpcs])
+      if isinstance(result,Future) and not result._done:
+        self._callback = result._callback
+        self._rpcs = result._rpcs
+      else:
+        self._result = result._result if isinstance(result,Future) else result
+        self._done = True
+    return self._done
+    
+  def get_result(self):
+    """Wait for the result and return it"""
+    while not self._step():
+      pass
+    return self._result
+    
+def wait_all(futures):
+  """
+  Wait for all of the futures and return their results as a list. Every future starts its next round of rpcs before any
+  of them waits on that round, so independent lookups cost about one round-trip per round rather than one each
+  """
+  pending = list(futures)
+  while len(pending) > 0:
+    pending = [f for f in pending if not f._step()]
+  return [f.get_result() for f in futures]
+  
+# Bitset functions. A bitset is a byte string with bit i in byte i/8, trailing zero bytes are dropped to keep it compact
+# bytes are handled as lists of ints rather than bytearrays, which python 2.5 doesnt have
+def set_bit(bits,i,value=True):
+  # return a copy of the bitset with bit i set (or cleared when value is False)
+  bits = [ord(c) for c in bits]
+  if len(bits) <= i//8:
+    bits.extend([0]*(i//8+1-len(bits)))
+  if value:
+    bits[i//8] |= 1 << (i%8)
+  else:
+    bits[i//8] &= ~(1 << (i%8))
+  return "".join([chr(b) for b in bits]).rstrip('\0')
+  
+def test_bit(bits,i):
+  # is bit i set in the bitset
+  return i//8 < len(bits) and (ord(bits[i//8]) & (1 << (i%8))) != 0
+  
+def to_bitset(ids):
+  # return a bitset with the bit for each of the ids set
+  bits = ''
+  for i in ids:
+    bits = set_bit(bits,i)
+  return bits
+  
+def union_bits(*bitsets):
+  # return the bitset of the bits set in any of the bitsets
+  bits = [0]*max([len(b) for b in bitsets] + [0])
+  for b in bitsets:
+    for i,c in enumerate(b):
+      bits[i] |= ord(c)
+  return "".join([chr(b) for b in bits])
+  
 # Memcache dependancy functions.
 # Tracks which stored memcache keys rely on other keys, this way when deleting or adding data we know which memcache data will be stale
-# TODO: finish thus
+# memcache key of the set of memcache keys that depend on an object
+DEPENDANTS_KEY=lambda k: str(k)+'_dependants'
+
 def add_dependants(memcache_key_name,dependant_keys):
-  """Update the memcache dependency sets of the given objects"""
-  for dependant_key in dependant_keys:
-    cache_key = str(dependant.key())+'_dependants'
-    cache_value = memcache.get(cache_key)
-    if cache_value:
-      cache_value.add(key)
-    else:
-      cache_value = set([key])
-    memcache.set(cache_key,cache_value)
+  """
+  Record that the value cached under memcache_key_name depends on each of the given objects (or keys).
+  The dependency sets are updated with compare-and-set so concurrent requests dont lose each others updates. If the sets
+  cant be updated the cached value is deleted instead, returns True if the dependencies were recorded
+  """
+  client = memcache.Client()
+  pending = [DEPENDANTS_KEY(object_to_key(k)) for k in dependant_keys]
+  for i in range(MEMCACHE_CAS_RETRIES):
+    if len(pending) == 0:
+      return True
+    current = client.get_multi(pending,for_cas=True)
+    new = dict([(k,set([memcache_key_name])) for k in pending if k not in current])
+    updated = dict([(k,v | set([memcache_key_name])) for k,v in current.items() if memcache_key_name not in v])
+    pending = []
+    if len(new) > 0:
+      pending.extend(client.add_multi(new))
+    if len(updated) > 0:
+      pending.extend(client.cas_multi(updated))
+  if len(pending) == 0:
+    return True
+  client.delete(memcache_key_name)
+  return False
   
 def remove_dependants(dependants):
-  """Remove the associated data from dependant keys"""
-  for dependant in dependants:
-    cache_key = str(dependant.key())+'_dependants'
-    cache_value = memcache.get(cache_key)
-    if cache_value:
-      for dependant_key in cache_value:
-        memcache.delete(dependant_key)
-    memcache.delete(cache_key)
+  """
+  Delete every cached value that depends on the given objects (or keys) with a single delete_multi.
+  Returns the set of memcache keys that were deleted
+  """
+  client = memcache.Client()
+  pending = [DEPENDANTS_KEY(object_to_key(d)) for d in dependants]
+  stale = set()
+  for i in range(MEMCACHE_CAS_RETRIES):
+    if len(pending) == 0:
+      break
+    current = client.get_multi(pending,for_cas=True)
+    for v in current.values():
+      stale |= v
+    # empty the sets with cas so keys added since they were read are picked up on the next pass
+    emptied = dict([(k,set()) for k,v in current.items() if len(v) > 0])
+    pending = client.cas_multi(emptied) if len(emptied) > 0 else []
+  if len(pending) > 0:
+    client.delete_multi(pending)
+  if len(stale) > 0:
+    client.delete_multi(list(stale))
+  return stale
 
 # take a list of objects and return a keyname which is the concatenation of those objects with spaces removed
 def key_name(*args):
@@ -65,6 +209,15 @@ def key_name(*args):
   name = "".join(args)
   return name.lower().replace(' ','')
   
+# take a list of objects and/or keys and return a keyname built from their datastore keys
+# unlike key_name this keeps the case of the encoded keys (which are case sensitive) so names cant collide
+def keys_key_name(*args):
+  return ":".join([str(object_to_key(a)) for a in args])
+  
+# the reverse of keys_key_name, returns the list of keys the key name was built from
+def key_name_to_keys(name):
+  return [db.Key(k) for k in name.split(":")]
+  
 def key_to_object(key):
   # if its a key return the object, if its not a key just pass the object back
   if isinstance(key,db.Key):
@@ -0,0 +1,174 @@
+# Memcache client that encodes values with utils.codec and stores values too big for a single memcache item.
+
+import uuid
+from time import sleep
+import zlib
+from google.appengine.api import memcache
+from constants import MEMCACHE_CHUNK_SIZE, MEMCACHE_COMPRESS, CACHE_LEASE_TIME, CACHE_LEASE_WAIT, CACHE_LEASE_RETRIES, CACHE_STALE_TIME
+from utils import Future
+from utils import codec
+
+# marker at the start of the manifest stored in place of a chunked value
+MANIFEST = "pglib.cache.chunked"
+# memcache key of each chunk of a value, the id is new for every write so readers never mix chunks from two writes
+CHUNK_KEY=lambda key,id,i: str(key)+"_chunk_"+id+"_"+str(i)
+# memcache keys of the lease taken by the request filling a missing key, and of the last value filled for a key
+LEASE_KEY=lambda key: str(key)+"_lease"
+STALE_KEY=lambda key: str(key)+"_stale"
+
+class Client(object):
+  """
+  Wraps a memcache.Client so values are stored with utils.codec and values whose encoding is larger than
+  MEMCACHE_CHUNK_SIZE are optionally compressed and split across several keys. The value key holds a manifest of
+  (MANIFEST, id, chunk count, checksum, compressed) and the chunks are read back with one more get_multi. A value with a
+  missing chunk, a bad checksum or an unknown encoding is treated as a miss.
+  gets and cas encode and decode values too but dont split them, use them for small values only.
+  Everything else (delete, incr...) is passed straight through to memcache.
+  """
+  def __init__(self,client=None):
+    self._client = client or memcache.Client()
+    
+  def __getattr__(self,name):
+    return getattr(self._client,name)
+    
+  def get(self,key):
+    return self.get_multi([key]).get(key)
+    
+  def get_multi(self,keys):
+    return self.get_multi_async(keys).get_result()
+    
+  def get_multi_async(self,keys):
+    """Start getting the keys and return a utils.Future of the {key: value} dict get_multi would return"""
+    def assemble(found):
+      found = _decode_multi(found)
+      manifests = dict([(k,v) for k,v in found.items() if _is_manifest(v)])
+      if len(manifests) == 0:
+        return found
+      for k in manifests:
+        del found[k]
+      chunk_keys = []
+      for k,(marker,id,count,checksum,compressed) in manifests.items():
+        chunk_keys.extend([CHUNK_KEY(k,id,i) for i in range(count)])
+      def join(chunks):
+        for k,(marker,id,count,checksum,compressed) in manifests.items():
+          parts = [chunks.get(CHUNK_KEY(k,id,i)) for i in range(count)]
+          if None in parts:
+            continue
+          data = "".join(parts)
+          if zlib.crc32(data) & 0xffffffff != checksum:
+            continue
+          found.update(_decode_multi({k:zlib.decompress(data) if compressed else data}))
+        return found
+      return Future(join,self._client.get_multi_async(chunk_keys))
+    return Future(assemble,self._client.get_multi_async(keys))
+    
+  def gets(self,key):
+    return _decode_multi({key:self._client.gets(key)}).get(key)
+    
+  def set(self,key,value,time=0):
+    return len(self.set_multi({key:value},time)) == 0
+    
+  def set_multi(self,mapping,time=0):
+    """Set every key in mapping with one memcache set_multi, returns the list of keys that couldnt be stored"""
+    values, chunks, chunked = _encode_multi(mapping)
+    values.update(chunks)
+    failed = frozenset(self._client.set_multi(values,time=time))
+    return [key for key in mapping if key in failed or len([k for k in chunked.get(key,[]) if k in failed]) > 0]
+    
+  def add(self,key,value,time=0):
+    return len(self.add_multi({key:value},time)) == 0
+    
+  def add_multi(self,mapping,time=0):
+    """Add every key in mapping that isnt already stored, returns the list of keys that werent added"""
+    values, chunks, chunked = _encode_multi(mapping)
+    # the chunks of a big value are set first, they are only read once the manifest has been added
+    failed = frozenset(self._client.set_multi(chunks,time=time)) if len(chunks) > 0 else frozenset()
+    for key in chunked:
+      if len([k for k in chunked[key] if k in failed]) > 0:
+        del values[key]
+    failed = frozenset(self._client.add_multi(values,time=time))
+    return [key for key in mapping if key in failed or key not in values]
+    
+  def cas(self,key,value,time=0):
+    return self._client.cas(key,codec.encode(value),time=time)
+    
+  def lease_multi(self,keys):
+    """
+    Try to take the fill lease on each missing key with one add_multi, returns the list of keys this request should
+    fill from the datastore (and then pass to fill_multi). The other keys are being filled by another request, see wait_multi
+    """
+    if len(keys) == 0:
+      return []
+    failed = frozenset(self._client.add_multi(dict([(LEASE_KEY(k),1) for k in keys]),time=CACHE_LEASE_TIME))
+    return [k for k in keys if LEASE_KEY(k) not in failed]
+    
+  def wait_multi(self,keys,stale=True):
+    """
+    Return {key: value} for the keys leased by other requests: the stale copy straight away if there is one (and stale is
+    set), otherwise the filled value once it appears. Keys still missing after CACHE_LEASE_RETRIES polls are left out
+    so the caller can fetch them itself
+    """
+    found = {}
+    if stale and len(keys) > 0:
+      copies = self.get_multi([STALE_KEY(k) for k in keys])
+      found.update(dict([(k,copies[STALE_KEY(k)]) for k in keys if STALE_KEY(k) in copies]))
+    for i in range(CACHE_LEASE_RETRIES):
+      waiting = [k for k in keys if k not in found]
+      if len(waiting) == 0:
+        break
+      sleep(CACHE_LEASE_WAIT)
+      found.update(self.get_multi(waiting))
+    return found
+    
+  def fill_multi(self,mapping,leased,time=0,stale=True):
+    """
+    Store values fetched after a miss and release the leases this request holds, leased is the list lease_multi
+    returned (values fetched after wait_multi gave up are stored too but the lease belongs to another request). Values
+    are added rather than set so a newer value written while they were being fetched isnt overwritten. With stale a copy
+    of each value is kept for CACHE_STALE_TIME seconds for wait_multi to hand out while the key is being filled again.
+    Returns the list of keys that werent stored
+    """
+    if len(mapping) == 0:
+      return []
+    failed = self.add_multi(mapping,time=time)
+    if stale:
+      self.set_multi(dict([(STALE_KEY(k),v) for k,v in mapping.items()]),time=CACHE_STALE_TIME)
+    owned = [LEASE_KEY(k) for k in mapping if k in leased]
+    if len(owned) > 0:
+      self._client.delete_multi(owned)
+    return failed
+    
+def _encode_multi(mapping):
+  # encode the values in mapping, returns ({key: encoded value or manifest}, {chunk key: chunk}, {key: chunk keys})
+  values = {}
+  chunks = {}
+  chunked = {}
+  for key,value in mapping.items():
+    data = codec.encode(value)
+    if len(data) <= MEMCACHE_CHUNK_SIZE:
+      values[key] = data
+      continue
+    compressed = MEMCACHE_COMPRESS
+    if compressed:
+      data = zlib.compress(data)
+    id = uuid.uuid4().hex
+    parts = [data[i:i+MEMCACHE_CHUNK_SIZE] for i in range(0,len(data),MEMCACHE_CHUNK_SIZE)]
+    for i,part in enumerate(parts):
+      chunks[CHUNK_KEY(key,id,i)] = part
+    values[key] = codec.encode((MANIFEST,id,len(parts),zlib.crc32(data) & 0xffffffff,compressed))
+    chunked[key] = [CHUNK_KEY(key,id,i) for i in range(len(parts))]
+  return values, chunks, chunked
+  
+def _decode_multi(found):
+  # decode the values in a {key: encoded value} dict, dropping misses and values that cant be decoded
+  values = {}
+  for k,data in found.items():
+    try:
+      values[k] = codec.decode(data)
+    except ValueError:
+      pass
+  return values
+  
+def _is_manifest(value):
+  # True if the value is the manifest of a chunked value (the json codec turns the tuple into a list)
+  return isinstance(value,(tuple,list)) and len(value) == 5 and value[0] == MANIFEST
@@ -0,0 +1,78 @@
+# Codecs for values stored in memcache.
+# Every encoded value starts with a version byte naming the codec that wrote it, so the codec can be changed (or a new
+# one added) without flushing memcache: values written by the old codec are still decoded by it.
+
+import cPickle as pickle
+import marshal
+import types
+try:
+  import json
+except ImportError:
+  from django.utils import simplejson as json
+from constants import CACHE_CODEC
+
+# the types the marshal and json codecs store as themselves. Subclasses such as db.Text, db.Link and db.Blob are
+# written as their base type (or garbled, marshal writes unicode subclasses through the buffer interface) so they are pickled
+_BUILTIN_TYPES = (types.NoneType, bool, int, long, float, str, unicode)
+
+# version byte: (name, encode, decode)
+_codecs = {}
+# codec name: version byte
+_versions = {}
+
+def register(name, version, encode, decode):
+  """
+  Add a codec. encode turns a value into a str and should raise ValueError (or TypeError) for values it cant handle,
+  those are stored with the pickle codec instead. decode turns the str back into the value
+  """
+  if len(version) != 1:
+    raise ValueError("codec version must be a single byte")
+  _codecs[version] = (name, encode, decode)
+  _versions[name] = version
+
+def encode(value, name=None):
+  """
+  Encode a value with the named codec (CACHE_CODEC by default) and return a str starting with the codec's version byte
+  """
+  version = _versions[name or CACHE_CODEC]
+  try:
+    return version + _codecs[version][1](value)
+  except (ValueError, TypeError):
+    return _versions['pickle'] + _codecs[_versions['pickle']][1](value)
+
+def decode(data):
+  """
+  Decode a str made by encode, raises ValueError if it wasnt written by a known codec
+  """
+  if not isinstance(data,str) or len(data) == 0 or data[0] not in _codecs:
+    raise ValueError("value wasnt encoded by a registered codec")
+  return _codecs[data[0]][2](data[1:])
+
+def _check_builtin(value):
+  # raise ValueError unless the value is made only of builtin types, compared exactly so subclasses are rejected
+  pending = [value]
+  while len(pending) > 0:
+    v = pending.pop()
+    if type(v) in (list, tuple, set, frozenset):
+      pending.extend(v)
+    elif type(v) is dict:
+      pending.extend(v.keys())
+      pending.extend(v.values())
+    elif type(v) not in _BUILTIN_TYPES:
+      raise ValueError("cant store values of type "+type(v).__name__+" without pickle")
+  
+def _marshal_dumps(value):
+  # marshal version 2 is read and written by python 2.5 onwards
+  _check_builtin(value)
+  return marshal.dumps(value,2)
+  
+def _json_dumps(value):
+  # json would write subclasses as their base type too
+  _check_builtin(value)
+  return json.dumps(value,separators=(',',':'))
+
+register('pickle','\x01',lambda v: pickle.dumps(v,pickle.HIGHEST_PROTOCOL),pickle.loads)
+# builtin types only (dicts, lists, strings, numbers, booleans, None, sets): compact and much faster than pickle
+register('marshal','\x02',_marshal_dumps,marshal.loads)
+# readable from other languages, strings come back as unicode and tuples as lists
+register('json','\x03',_json_dumps,json.loads)
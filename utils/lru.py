@@ -0,0 +1,118 @@
+# Bounded in-process cache, the tier between the request cache and memcache.
+
+import threading
+import time
+from constants import LOCAL_CACHE_SIZE, LOCAL_CACHE_TIME, LOCAL_CACHE_BYTES, LOCAL_CACHE_VALUE_BYTES
+from utils import codec
+
+class LRUCache(object):
+  """
+  A thread-safe cache of at most max_entries values, and about max_bytes bytes, kept in instance memory. The size of a
+  value is the length of its utils.codec encoding, values bigger than max_value bytes arent cached at all. Each entry
+  expires ttl seconds after it was set (0 = never) and the least recently used entries are evicted when the cache is
+  full. Keeps hit, miss and eviction counts, see stats. Values are shared between threads so treat them as read-only.
+  """
+  def __init__(self,max_entries=LOCAL_CACHE_SIZE,ttl=LOCAL_CACHE_TIME,max_bytes=LOCAL_CACHE_BYTES,max_value=LOCAL_CACHE_VALUE_BYTES):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+    self.max_value = max_value
+    self._lock = threading.Lock()
+    self.clear()
+    
+  def get(self,key,default=None):
+    """Return the value for key, or default if it isnt cached or has expired"""
+    return self.get_multi([key]).get(key,default)
+    
+  def get_multi(self,keys):
+    """Return a dict of {key: value} for the keys that are cached"""
+    found = {}
+    now = time.time()
+    self._lock.acquire()
+    try:
+      for key in keys:
+        link = self._entries.get(key)
+        if link is None or (link[3] and link[3] < now):
+          if link is not None:
+            self._unlink(link)
+          self.misses += 1
+          continue
+        # move to the most recently used end of the list
+        self._unlink(link)
+        self._append(link)
+        found[key] = link[2]
+        self.hits += 1
+    finally:
+      self._lock.release()
+    return found
+    
+  def set(self,key,value,ttl=None):
+    self.set_multi({key:value},ttl)
+    
+  def set_multi(self,mapping,ttl=None):
+    """Cache every value in mapping, ttl overrides the cache's ttl for these entries"""
+    ttl = self.ttl if ttl is None else ttl
+    expires = time.time()+ttl if ttl else 0
+    # sized outside the lock, encoding is the slow part
+    sizes = dict([(key,len(codec.encode(value))) for key,value in mapping.items()])
+    self._lock.acquire()
+    try:
+      for key,value in mapping.items():
+        if key in self._entries:
+          self._unlink(self._entries[key])
+        if sizes[key] <= self.max_value:
+          self._append([None,None,value,expires,key,sizes[key]])
+      while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+        self._unlink(self._root[1])
+        self.evictions += 1
+    finally:
+      self._lock.release()
+    
+  def delete(self,key):
+    self.delete_multi([key])
+    
+  def delete_multi(self,keys):
+    self._lock.acquire()
+    try:
+      for key in keys:
+        if key in self._entries:
+          self._unlink(self._entries[key])
+    finally:
+      self._lock.release()
+    
+  def clear(self):
+    """Drop every entry and reset the counters"""
+    self._lock.acquire()
+    try:
+      # the entries form a circular doubly linked list of [prev, next, value, expires, key, size] through _root, oldest first
+      self._root = [None,None,None,None,None,0]
+      self._root[0] = self._root[1] = self._root
+      self._entries = {}
+      # the total size of the entries
+      self.bytes = 0
+      self.hits = self.misses = self.evictions = 0
+    finally:
+      self._lock.release()
+    
+  def stats(self):
+    """Return a dict of the hit, miss and eviction counts and the number of entries"""
+    return {'hits':self.hits,'misses':self.misses,'evictions':self.evictions,'entries':len(self._entries)}
+    
+  def _append(self,link):
+    # add the link at the most recently used end, the lock must be held
+    last = self._root[0]
+    link[0] = last
+    link[1] = self._root
+    last[1] = self._root[0] = link
+    self._entries[link[4]] = link
+    self.bytes += link[5]
+    
+  def _unlink(self,link):
+    # remove the link from the list and the index, the lock must be held
+    link[0][1] = link[1]
+    link[1][0] = link[0]
+    del self._entries[link[4]]
+    self.bytes -= link[5]
+    
+# the tier shared by settings and permissions (used when USE_LOCAL_CACHE is set), so one bound covers both
+shared = LRUCache()
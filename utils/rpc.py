@@ -0,0 +1,154 @@
+# RPC accounting for pglib calls.
+# apiproxy pre and post call hooks count the datastore, memcache (and other) RPCs made while a pglib function decorated
+# with accounted is running, with their bytes and latencies. Turned on by constants.RPC_ACCOUNTING, when it is off the
+# decorator only checks the constant and the hooks are never installed.
+
+import threading
+import time
+import constants
+
+# upper bounds in milliseconds of the latency histogram buckets, the last bucket holds everything slower
+BUCKETS = [1,2,5,10,20,50,100,200,500,1000]
+# name used for the hooks in the apiproxy hook lists
+HOOK_NAME = "pglib_rpc_accounting"
+
+# per-thread state: the outermost accounted function running, the rpcs started and not yet finished, the request summary
+_local = threading.local()
+# process wide totals {function: stats}, see histogram
+_totals = {}
+_totals_lock = threading.Lock()
+# the apiproxy the hooks were installed on, gaeunit swaps in a new one for every test run
+_installed = {'apiproxy':None}
+
+def accounted(func):
+  """
+  Decorator for public pglib functions, RPCs made while the function runs are counted against it (as module.function).
+  Calls made from inside another accounted function are counted against the outer one.
+  RPCs made later by a Future the function returned are counted against whatever is running when they are started
+  """
+  name = func.__module__.split('.')[0]+'.'+func.__name__
+  def wrapped(*args, **kwargs):
+    if not constants.RPC_ACCOUNTING or getattr(_local,'function',None) is not None:
+      return func(*args, **kwargs)
+    _install()
+    _local.function = name
+    _stats(_summary(),name)['calls'] += 1
+    _totals_lock.acquire()
+    try:
+      _stats(_totals,name)['calls'] += 1
+    finally:
+      _totals_lock.release()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      _local.function = None
+  wrapped.__name__ = func.__name__
+  wrapped.__doc__ = func.__doc__
+  wrapped.__module__ = func.__module__
+  return wrapped
+
+def summary():
+  """
+  Return the RPCs made by pglib functions during this request as {function: stats}. stats is a dict of 'calls' (number
+  of calls to the function), 'rpcs', 'bytes' (requests plus responses), 'ms' (total rpc latency), 'latency' (a list of
+  rpc counts per BUCKETS bucket) and 'services' ({'service.Call': rpc count})
+  """
+  return _copy(_summary())
+
+def histogram():
+  """
+  Return the totals for every pglib function since the process started (or clear was called), in the same form as summary
+  """
+  _totals_lock.acquire()
+  try:
+    return _copy(_totals)
+  finally:
+    _totals_lock.release()
+
+def reset():
+  """
+  Start a new request summary, call this at every request boundary (or wrap the application with middleware)
+  """
+  _local.summary = {}
+
+def clear():
+  """
+  Reset the process wide totals
+  """
+  _totals_lock.acquire()
+  try:
+    _totals.clear()
+  finally:
+    _totals_lock.release()
+
+def middleware(app):
+  """
+  Wrap a WSGI application so the request summary is reset at the start of every request
+  """
+  def wrapped_app(environ, start_response):
+    reset()
+    return app(environ, start_response)
+  return wrapped_app
+
+def _install():
+  # add the hooks to the current apiproxy if they arent there already
+  from google.appengine.api import apiproxy_stub_map
+  apiproxy = apiproxy_stub_map.apiproxy
+  if _installed['apiproxy'] is not apiproxy:
+    apiproxy.GetPreCallHooks().Append(HOOK_NAME,_precall)
+    apiproxy.GetPostCallHooks().Append(HOOK_NAME,_postcall)
+    _installed['apiproxy'] = apiproxy
+
+def _summary():
+  # this request's summary
+  if not hasattr(_local,'summary'):
+    reset()
+  return _local.summary
+
+def _pending():
+  # {id(response): (function, start time)} for the rpcs started on this thread and not yet finished
+  if not hasattr(_local,'pending'):
+    _local.pending = {}
+  return _local.pending
+
+def _stats(totals,name):
+  # the stats dict for name in totals, created empty if needed
+  if name not in totals:
+    totals[name] = {'calls':0,'rpcs':0,'bytes':0,'ms':0.0,'latency':[0]*(len(BUCKETS)+1),'services':{}}
+  return totals[name]
+
+def _record(totals,name,service,size,ms):
+  # add one rpc to the stats for name
+  stats = _stats(totals,name)
+  stats['rpcs'] += 1
+  stats['bytes'] += size
+  stats['ms'] += ms
+  stats['latency'][len([b for b in BUCKETS if b < ms])] += 1
+  stats['services'][service] = stats['services'].get(service,0)+1
+
+def _copy(totals):
+  # a deep enough copy of {function: stats} to hand out
+  return dict([(name,dict(stats,latency=list(stats['latency']),services=dict(stats['services']))) for name,stats in totals.items()])
+
+def _precall(service, call, request, response):
+  function = getattr(_local,'function',None)
+  if constants.RPC_ACCOUNTING and function is not None:
+    _pending()[id(response)] = (function,time.time())
+
+def _postcall(service, call, request, response):
+  started = _pending().pop(id(response),None)
+  if started is None:
+    return
+  function, start = started
+  ms = (time.time()-start)*1000
+  size = 0
+  for message in (request,response):
+    if hasattr(message,'ByteSize'):
+      size += message.ByteSize()
+  name = service+'.'+call
+  _record(_summary(),function,name,size,ms)
+  _totals_lock.acquire()
+  try:
+    _record(_totals,function,name,size,ms)
+  finally:
+    _totals_lock.release()